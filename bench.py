@@ -0,0 +1,353 @@
+''' Rough benchmarks for generated parsers.
+
+    python bench.py [copies] [benchmark ...]
+
+    Inputs are built by repeating the files under tests/ `copies` times.
+    With no benchmark names given, all of them are run but the stress
+    tests, for which `copies` is a size instead: megabytes of input for
+    bigfile, and rules in the grammar for generate.
+
+    python bench.py 1024 bigfile
+    python bench.py 5000 generate
+'''
+import sys, os, time, types, tempfile, resource
+from collections import deque
+import importlib.util
+from array import array
+import pygll, emitter
+
+def load(path, name):
+    # Import a parser module from a file
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def build(grammar, name, table=False, dfa=False, contextual=False, optimize=False, inline=False,
+          instrument=False, profile=None):
+    # Generate a parser for grammar and import it without writing it out
+    with open(grammar) as f:
+        text = pygll.generate(f.read(), table=table, dfa=dfa, contextual=contextual, optimize=optimize,
+                              inline=inline, instrument=instrument, profile=profile)
+    module = types.ModuleType(name)
+    exec(compile(text, grammar, 'exec'), module.__dict__)
+    return module
+
+def timeit(f, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, times):
+    base = times[0][1]
+    for label, t in times:
+        print("{:<12} {:<10} {:9.4f}s  {:5.2f}x".format(name, label, t, base / t))
+
+def lang1input(copies):
+    with open("tests/lang1/test1") as f:
+        return f.read() * copies
+
+def ebnfinput():
+    with open("tests/mlgrammar.ebnf") as f:
+        return f.read()
+
+def many(parser, s, copies):
+    # Parse s copies times with a fresh Parser each time. Used where the
+    # grammar's right-recursive lists would overflow the stack on one
+    # long input.
+    for i in range(copies):
+        parser().parse(s)
+
+def benchparsers(copies):
+    # Old checked-in parsers against ones freshly generated by this tree
+    lang1 = lang1input(copies)
+    old = load("tests/lang1/parser.py", "oldlang1")
+    new = build("tests/lang1/grammar.ebnf", "newlang1")
+    report("lang1", [
+        ("old", timeit(lambda: old.Parser().parse(lang1))),
+        ("new", timeit(lambda: new.Parser().parse(lang1))),
+    ])
+
+    ebnf = ebnfinput()
+    new = build("tests/ebnf-extended/ebnf-extended.ebnf", "newebnf")
+    report("mlgrammar", [
+        ("old", timeit(lambda: many(pygll.Parser, ebnf, copies))),
+        ("new", timeit(lambda: many(new.Parser, ebnf, copies))),
+    ])
+
+def benchprecedence(copies):
+    # lang1's cascade of expression rules against precedence climbing
+    s = "x = 1 + 2 * (3 - y) / 5 + a * b - 7;\nif x < 4 then { print x * 2 + 1; }\n" * copies
+    cascade = build("tests/lang1/grammar.ebnf", "cascade")
+    pratt = build("tests/lang1/precedence.ebnf", "pratt")
+    report("precedence", [
+        ("cascade", timeit(lambda: cascade.Parser().parse(s))),
+        ("pratt", timeit(lambda: pratt.Parser().parse(s))),
+    ])
+
+def benchvalidate(copies):
+    # Recognizer-only validate() against a full parse()
+    lang1 = build("tests/lang1/grammar.ebnf", "lang1")
+    s = lang1input(copies)
+    report("validate", [
+        ("parse", timeit(lambda: lang1.Parser().parse(s))),
+        ("validate", timeit(lambda: lang1.validate(s))),
+    ])
+
+def benchevents(copies):
+    # Draining iterparse() against a full parse(), for both backends
+    s = lang1input(copies)
+    for name, table in (("lang1", False), ("lang1-table", True)):
+        lang1 = build("tests/lang1/grammar.ebnf", name, table)
+        report("events " + name, [
+            ("parse", timeit(lambda: lang1.Parser().parse(s))),
+            ("iterparse", timeit(lambda: deque(lang1.iterparse(s), 0))),
+        ])
+
+def benchbytes(copies):
+    # Lexing and validating a str against the same input as bytes, whose
+    # tokens are kept as (start, end) spans
+    lang1 = build("tests/lang1/grammar.ebnf", "lang1")
+    s = lang1input(copies)
+    b = s.encode()
+    report("bytes lex", [
+        ("str", timeit(lambda: deque(lang1.Parser().tokenize(s), 0))),
+        ("bytes", timeit(lambda: deque(lang1.Parser().tokenize(b), 0))),
+    ])
+    report("bytes", [
+        ("str", timeit(lambda: lang1.validate(s))),
+        ("bytes", timeit(lambda: lang1.validate(b))),
+    ])
+
+def bencharrays(copies):
+    # tokenize_arrays() against building the same arrays from tokenize()
+    lang1 = build("tests/lang1/grammar.ebnf", "lang1")
+    s = lang1input(copies)
+    def fromtokens():
+        kinds, starts, ends = array('H'), array('I'), array('I')
+        for kind, text, start in lang1.Parser().tokenize(s):
+            if kind is None:
+                break  # the (None, None, offset) that ends the tokens
+            kinds.append(kind)
+            starts.append(start)
+            ends.append(start + len(text))
+    report("arrays", [
+        ("tokenize", timeit(fromtokens)),
+        ("arrays", timeit(lambda: lang1.tokenize_arrays(s))),
+    ])
+
+def benchlexers(copies):
+    # The master regex against the --dfa lexer, tokenizing each test grammar
+    with open("tests/simplemath/simple.math") as f:
+        math = f.read() * copies
+    cases = [
+        ("lang1", "tests/lang1/grammar.ebnf", lang1input(copies)),
+        ("precedence", "tests/lang1/precedence.ebnf", lang1input(copies)),
+        ("simplemath", "tests/simplemath/simplemath.ebnf", math),
+        ("mlgrammar", "tests/ebnf-extended/ebnf-extended.ebnf", ebnfinput() * copies),
+    ]
+    for name, grammar, s in cases:
+        regex = build(grammar, name)
+        dfa = build(grammar, name + "-dfa", dfa=True)
+        report("lex " + name, [
+            ("regex", timeit(lambda: deque(regex.Parser().tokenize(s), 0))),
+            ("dfa", timeit(lambda: deque(dfa.Parser().tokenize(s), 0))),
+        ])
+
+def benchcontextual(copies):
+    # Parsing with the master regex against --contextual lexing
+    cases = [
+        ("lang1", "tests/lang1/grammar.ebnf", lang1input(copies)),
+        ("precedence", "tests/lang1/precedence.ebnf", lang1input(copies)),
+    ]
+    for name, grammar, s in cases:
+        regex = build(grammar, name)
+        contextual = build(grammar, name + "-contextual", contextual=True)
+        report("ctx " + name, [
+            ("regex", timeit(lambda: regex.Parser().parse(s))),
+            ("contextual", timeit(lambda: contextual.Parser().parse(s))),
+        ])
+    ebnf = ebnfinput()
+    regex = build("tests/ebnf-extended/ebnf-extended.ebnf", "ebnf")
+    contextual = build("tests/ebnf-extended/ebnf-extended.ebnf", "ebnf-contextual", contextual=True)
+    report("ctx mlgrammar", [
+        ("regex", timeit(lambda: many(regex.Parser, ebnf, copies))),
+        ("contextual", timeit(lambda: many(contextual.Parser, ebnf, copies))),
+    ])
+
+def benchtokens(copies):
+    # parse() lexing the input against parse_tokens() given it pre-lexed
+    lang1 = build("tests/lang1/grammar.ebnf", "lang1")
+    s = lang1input(copies)
+    tokens = [(lang1.TOKNAMES[kind], text, (start, start + len(text)))
+              for kind, text, start in lang1.Parser().tokenize(s) if kind is not None]
+    report("tokens", [
+        ("parse", timeit(lambda: lang1.Parser().parse(s))),
+        ("parse_tokens", timeit(lambda: lang1.parse_tokens(iter(tokens)))),
+    ])
+
+def manyalternatives(alternatives):
+    # A grammar whose Statement rule has one production per keyword, and
+    # input using each of them in turn
+    words = ["kw{}".format(i) for i in range(alternatives)]
+    grammar = "%root Program\n%tokens\n"
+    grammar += ''.join("{} '{}'\n".format(word, word) for word in words)
+    grammar += "number '[0-9]+'\nname '\\w+'\n%grammar\nProgram := Statement [Statement] ;\nStatement := "
+    grammar += "\n    | ".join("{} name number ';'  # S{} _ name value _".format(word, i) for i, word in enumerate(words))
+    grammar += " ;\n"
+    s = ''.join("{} x {};\n".format(words[i % alternatives], i) for i in range(1000))
+    return grammar, s
+
+def benchdispatch(copies):
+    # Testing a rule's alternatives in turn against a dict dispatch, as the
+    # number of alternatives grows
+    default = emitter.DISPATCH
+    for alternatives in (2, 4, 8, 30):
+        grammar, s = manyalternatives(alternatives)
+        s *= max(1, copies // 100)
+        times = []
+        for label, dispatch in (("tests", 1 << 30), ("dict", alternatives)):
+            emitter.DISPATCH = dispatch
+            module = types.ModuleType("many")
+            exec(compile(pygll.generate(grammar), "many", 'exec'), module.__dict__)
+            times.append((label, timeit(lambda: module.Parser().parse(s))))
+        emitter.DISPATCH = default
+        report("alts {}".format(alternatives), times)
+
+def benchoptimize(copies):
+    # Parsing tests/simplemath with and without -O. The input is one
+    # expression, short enough to stay within the recursion limit, parsed
+    # copies times; the per-token cost is timed with parse_tokens() on the
+    # expression already lexed, so that lexing doesn't hide it.
+    with open("tests/simplemath/simple.math") as f:
+        s = " + ".join([f.read().strip()] * 50)
+    plain = build("tests/simplemath/simplemath.ebnf", "simplemath")
+    optimized = build("tests/simplemath/simplemath.ebnf", "simplemath-O", optimize=True)
+    tokens = [(plain.TOKNAMES[kind], text) for kind, text, start in plain.Parser().tokenize(s) if kind is not None]
+    def pretokenized(module):
+        for i in range(copies):
+            module.parse_tokens(tokens)
+    report("simplemath", [
+        ("default", timeit(lambda: many(plain.Parser, s, copies))),
+        ("-O", timeit(lambda: many(optimized.Parser, s, copies))),
+    ])
+    times = [
+        ("default", timeit(lambda: pretokenized(plain))),
+        ("-O", timeit(lambda: pretokenized(optimized))),
+    ]
+    report("per token", times)
+    for label, t in times:
+        print("{:<12} {:<10} {:6.0f} ns/token".format("", label, t / (len(tokens) * copies) * 1e9))
+
+def benchinline(copies):
+    # Parse functions called for each rule against --inline, which splices
+    # lang1's unit and single-use rules into the rules using them, on the
+    # tokens already lexed so that lexing doesn't hide the calls saved
+    s = lang1input(copies)
+    for label, optimize in (("lang1", False), ("lang1 -O", True)):
+        plain = build("tests/lang1/grammar.ebnf", "lang1", optimize=optimize)
+        inlined = build("tests/lang1/grammar.ebnf", "lang1-inline", optimize=optimize, inline=True)
+        tokens = [(plain.TOKNAMES[kind], text) for kind, text, start in plain.Parser().tokenize(s) if kind is not None]
+        report(label, [
+            ("calls", timeit(lambda: plain.parse_tokens(tokens), 10)),
+            ("--inline", timeit(lambda: inlined.parse_tokens(tokens), 10)),
+        ])
+
+def benchprofile(copies):
+    # Productions tested in the order written against --profile-data, with
+    # the profile taken on the input being parsed, on the tokens already
+    # lexed. mlgrammar is parsed copies times, being too deep to repeat.
+    cases = [
+        ("lang1", "tests/lang1/grammar.ebnf", lang1input(copies), 1),
+        ("mlgrammar", "tests/ebnf-extended/ebnf-extended.ebnf", ebnfinput(), copies),
+    ]
+    for name, grammar, s, repeat in cases:
+        plain = build(grammar, name)
+        profiling = build(grammar, name + "-profile", instrument=True)
+        profiling.Parser().parse(s)
+        profiled = build(grammar, name + "-profiled", profile=profiling.PROFILE)
+        tokens = [(plain.TOKNAMES[kind], text) for kind, text, start in plain.Parser().tokenize(s) if kind is not None]
+        def parse(module):
+            for i in range(repeat):
+                module.parse_tokens(tokens)
+        report(name, [
+            ("written", timeit(lambda: parse(plain), 10)),
+            ("profiled", timeit(lambda: parse(profiled), 10)),
+        ])
+
+def benchbigfile(megabytes):
+    # parse_iter over a file of `megabytes` MB of lang1 statements, read in
+    # chunks; peak memory should stay flat however big the file is
+    lang1 = build("tests/lang1/grammar.ebnf", "lang1")
+    text = lang1input(1)
+    copies = megabytes * (1 << 20) // len(text) + 1
+    with tempfile.NamedTemporaryFile("w", suffix=".lang1", delete=False) as f:
+        for i in range(copies):
+            f.write(text)
+    try:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        items = 0
+        with open(f.name) as source:
+            for item in lang1.parse_iter(source):
+                items += 1
+        t = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        os.remove(f.name)
+    print("{:<12} {} MB, {} statements in {:.1f}s ({:.2f} MB/s), peak RSS grew {} KB".format(
+        "bigfile", megabytes, items, t, megabytes / t, after - before))
+
+def manyrules(rules):
+    # A grammar of about `rules` rules, each expression level's operands
+    # being the next level down, so that the rules nest `rules` / 2 deep
+    levels = max(1, rules // 2)
+    grammar = "%root Program\n%tokens\n"
+    grammar += ''.join("op{} 'op{}'\n".format(i, i) for i in range(levels))
+    grammar += "number '[0-9]+'\nname '\\w+'\n%grammar\nProgram := E0 [E0] ;\n"
+    for i in range(levels):
+        grammar += "E{} := E{} R{} ;\nR{} := op{} E{} | $ ;\n".format(i, i + 1, i, i, i, i + 1)
+    grammar += "E{} := number | name | '\\(' E0 '\\)' ;\n".format(levels)
+    return grammar
+
+def benchgenerate(rules):
+    # Generating parsers for a grammar of `rules` rules
+    grammar = manyrules(rules)
+    report("rules {}".format(rules), [
+        ("generate", timeit(lambda: pygll.generate(grammar), 1)),
+        ("contextual", timeit(lambda: pygll.generate(grammar, contextual=True), 1)),
+        ("table", timeit(lambda: pygll.generate(grammar, table=True), 1)),
+    ])
+
+BENCHMARKS = {
+    "parsers": benchparsers,
+    "precedence": benchprecedence,
+    "validate": benchvalidate,
+    "events": benchevents,
+    "bytes": benchbytes,
+    "arrays": bencharrays,
+    "lexers": benchlexers,
+    "contextual": benchcontextual,
+    "tokens": benchtokens,
+    "dispatch": benchdispatch,
+    "optimize": benchoptimize,
+    "inline": benchinline,
+    "profile": benchprofile,
+    "bigfile": benchbigfile,
+    "generate": benchgenerate,
+}
+STRESS = ("bigfile", "generate")
+
+def main():
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    names = sys.argv[2:] or [x for x in BENCHMARKS if x not in STRESS]
+    for name in names:
+        BENCHMARKS[name](copies)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,641 @@
+''' Compile token regexes into one minimized DFA, for the --dfa lexer.
+
+    Only a regular subset of re's syntax is handled: literals and escapes,
+    classes, ., \\d \\w \\s and their negations, groups, |, and the greedy
+    quantifiers * + ? {m,n}. A pattern using anything else (lazy
+    quantifiers, backreferences, anchors, lookarounds, flags) raises
+    Unsupported, and is left for the re module to match.
+'''
+import re
+from bisect import bisect_right
+from collections import deque
+
+MAXCHAR = 0x10FFFF
+
+class Unsupported(Exception):
+    pass
+
+# Character sets are sorted lists of disjoint (lo, hi) code point ranges
+
+def union(*sets):
+    ranges = sorted(r for s in sets for r in s)
+    out = []
+    for lo, hi in ranges:
+        if out and lo <= out[-1][1] + 1:
+            out[-1] = (out[-1][0], max(out[-1][1], hi))
+        else:
+            out.append((lo, hi))
+    return out
+
+def complement(s):
+    out = []
+    lo = 0
+    for a, b in s:
+        if a > lo:
+            out.append((lo, a - 1))
+        lo = b + 1
+    if lo <= MAXCHAR:
+        out.append((lo, MAXCHAR))
+    return out
+
+def overlaps(a, b):
+    # Whether two character sets have a code point in common
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i][1] < b[j][0]:
+            i += 1
+        elif b[j][1] < a[i][0]:
+            j += 1
+        else:
+            return True
+    return False
+
+ALLCHARS = None
+CATEGORIES = {}
+
+def category(pattern, ascii=False):
+    # The code points re matches with pattern (such as \w), found once by
+    # running it over a string of every code point; with ascii, as a bytes
+    # pattern matches them
+    global ALLCHARS
+    if (pattern, ascii) not in CATEGORIES:
+        if ALLCHARS is None:
+            ALLCHARS = ''.join(map(chr, range(MAXCHAR + 1)))
+        flags = re.ASCII if ascii else 0
+        CATEGORIES[pattern, ascii] = [(m.start(), m.end() - 1) for m in re.finditer(pattern + '+', ALLCHARS, flags)]
+    return CATEGORIES[pattern, ascii]
+
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a', '0': '\0'}
+CLASSES = {'d': r'\d', 'w': r'\w', 's': r'\s'}
+
+class RegexParser(object):
+    # Parses a regex into a tree of ('set', ranges), ('cat', [nodes]),
+    # ('alt', [nodes]) and ('repeat', node, min, max) with max None for no
+    # limit. An empty sequence is ('cat', []). With lenient, lazy
+    # quantifiers are read as greedy ones, anchors as empty, and other
+    # escapes as ('unknown',), which is enough to find first sets. With
+    # ascii, \d \w and \s are those of a bytes pattern (see bytepattern).
+    def __init__(self, regex, lenient=False, ascii=False):
+        self.regex = regex
+        self.lenient = lenient
+        self.ascii = ascii
+        self.i = 0
+
+    def parse(self):
+        node = self.alt()
+        if self.i < len(self.regex):
+            raise Unsupported("unbalanced ) in {!r}".format(self.regex))
+        return node
+
+    def peek(self):
+        return self.regex[self.i] if self.i < len(self.regex) else None
+
+    def take(self):
+        c = self.regex[self.i]
+        self.i += 1
+        return c
+
+    def alt(self):
+        alts = [self.cat()]
+        while self.peek() == '|':
+            self.take()
+            alts.append(self.cat())
+        return alts[0] if len(alts) == 1 else ('alt', alts)
+
+    def cat(self):
+        items = []
+        while self.peek() not in (None, '|', ')'):
+            items.append(self.quantified(self.atom()))
+        return items[0] if len(items) == 1 else ('cat', items)
+
+    def quantified(self, node):
+        while True:
+            c = self.peek()
+            if c == '*':
+                low, high = 0, None
+            elif c == '+':
+                low, high = 1, None
+            elif c == '?':
+                low, high = 0, 1
+            elif c == '{':
+                m = re.compile(r'\{(\d*)(,?)(\d*)\}').match(self.regex, self.i)
+                if not m or not (m.group(1) or m.group(3)):
+                    return node  # a literal {
+                low = int(m.group(1) or 0)
+                high = int(m.group(3)) if m.group(3) else (None if m.group(2) else low)
+                self.i = m.end() - 1
+            else:
+                return node
+            self.take()
+            lazy = self.peek() == '?'
+            if self.peek() in ('?', '+') and self.lenient:
+                self.take()
+            elif self.peek() in ('?', '+'):
+                raise Unsupported("lazy or possessive quantifier in {!r}".format(self.regex))
+            node = self.repeat(node, low, high, lazy)
+
+    def repeat(self, node, low, high, lazy):
+        return ('repeat', node, low, high)
+
+    def atom(self):
+        c = self.take()
+        if c == '(':
+            if self.peek() == '?':
+                m = re.compile(r'\?(:|P<\w+>)').match(self.regex, self.i)
+                if not m:
+                    raise Unsupported("(? construct in {!r}".format(self.regex))
+                self.i = m.end()
+            node = self.alt()
+            if self.peek() != ')':
+                raise Unsupported("unbalanced ( in {!r}".format(self.regex))
+            self.take()
+            return node
+        elif c == '[':
+            return ('set', self.charclass())
+        elif c == '.':
+            return ('set', complement([(10, 10)]))
+        elif c == '\\':
+            try:
+                return ('set', self.escape())
+            except Unsupported:
+                if not self.lenient:
+                    raise
+                while (self.peek() or '').isdigit():
+                    self.take()
+                return ('unknown',)
+        elif c in '^$' and self.lenient:
+            return ('cat', [])
+        elif c in '^$':
+            raise Unsupported("anchor in {!r}".format(self.regex))
+        elif c in '*+?':
+            raise Unsupported("nothing to repeat in {!r}".format(self.regex))
+        return ('set', [(ord(c), ord(c))])
+
+    def escape(self):
+        if self.peek() is None:
+            raise Unsupported("trailing \\ in {!r}".format(self.regex))
+        c = self.take()
+        if c.lower() in CLASSES:
+            s = category(CLASSES[c.lower()], self.ascii)
+            return complement(s) if c.isupper() else s
+        elif c in ESCAPES and not (c == '0' and (self.peek() or '').isdigit()):
+            return [(ord(ESCAPES[c]),) * 2]
+        elif c in 'uU' and self.ascii:
+            raise Unsupported("\\{} in bytes pattern {!r}".format(c, self.regex))
+        elif c in 'xuU':
+            size = {'x': 2, 'u': 4, 'U': 8}[c]
+            digits = self.regex[self.i:self.i+size]
+            if len(digits) < size or not all(x in '0123456789abcdefABCDEF' for x in digits):
+                raise Unsupported("bad \\{} escape in {!r}".format(c, self.regex))
+            self.i += size
+            return [(int(digits, 16),) * 2]
+        elif c.isalnum():
+            # backreferences, \b, \A, \Z and the like
+            raise Unsupported("\\{} in {!r}".format(c, self.regex))
+        return [(ord(c), ord(c))]
+
+    def charclass(self):
+        negate = self.peek() == '^'
+        if negate:
+            self.take()
+        ranges = []
+        first = True
+        while True:
+            c = self.peek()
+            if c is None:
+                raise Unsupported("unterminated [ in {!r}".format(self.regex))
+            if c == ']' and not first:
+                self.take()
+                break
+            first = False
+            lo = self.classitem()
+            if self.peek() == '-' and self.regex[self.i+1:self.i+2] not in (']', ''):
+                self.take()
+                hi = self.classitem()
+                if len(lo) != 1 or len(hi) != 1 or lo[0][0] != lo[0][1] or hi[0][0] != hi[0][1]:
+                    raise Unsupported("bad range in {!r}".format(self.regex))
+                ranges.append([(lo[0][0], hi[0][0])])
+            else:
+                ranges.append(lo)
+        s = union(*ranges)
+        return complement(s) if negate else s
+
+    def classitem(self):
+        c = self.take()
+        if c == '\\':
+            return self.escape()
+        elif c == '[' and self.peek() in (':', '=', '.'):
+            raise Unsupported("[ in class in {!r}".format(self.regex))
+        return [(ord(c), ord(c))]
+
+class NFA(object):
+    # Thompson construction: each state has epsilon moves and (set, state)
+    # moves; accepting states map to the token they end
+    def __init__(self):
+        self.epsilon = []
+        self.moves = []
+        self.accept = {}
+
+    def state(self):
+        self.epsilon.append([])
+        self.moves.append([])
+        return len(self.epsilon) - 1
+
+    def build(self, node, start):
+        # Add node's states after start; returns the state it ends in
+        kind = node[0]
+        if kind == 'set':
+            end = self.state()
+            self.moves[start].append((node[1], end))
+            return end
+        elif kind == 'cat':
+            for item in node[1]:
+                start = self.build(item, start)
+            return start
+        elif kind == 'alt':
+            end = self.state()
+            for item in node[1]:
+                s = self.state()
+                self.epsilon[start].append(s)
+                self.epsilon[self.build(item, s)].append(end)
+            return end
+        item, low, high = node[1:]
+        for i in range(low):
+            start = self.build(item, start)
+        if high is None:
+            loop = self.state()
+            self.epsilon[start].append(loop)
+            self.epsilon[self.build(item, loop)].append(loop)
+            return loop
+        end = self.state()
+        self.epsilon[start].append(end)
+        for i in range(high - low):
+            start = self.build(item, start)
+            self.epsilon[start].append(end)
+        return end
+
+    def closure(self, states):
+        stack = list(states)
+        seen = set(stack)
+        while stack:
+            for t in self.epsilon[stack.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return frozenset(seen)
+
+def partition(sets):
+    # Split the code points into classes that every set either holds all of
+    # or none of. Returns the start of each range, the class of each range,
+    # and, for each set, the classes it holds.
+    points = set((0,))
+    for s in sets:
+        for lo, hi in s:
+            points.add(lo)
+            points.add(hi + 1)
+    starts = sorted(x for x in points if x <= MAXCHAR)
+    signatures = {}
+    rangeclass = []
+    members = [set() for s in sets]
+    for start in starts:
+        sig = tuple(i for i, s in enumerate(sets) if contains(s, start))
+        if sig not in signatures:
+            signatures[sig] = len(signatures)
+            for i in sig:
+                members[i].add(signatures[sig])
+        rangeclass.append(signatures[sig])
+    # merge neighbouring ranges of the same class
+    mstarts, mclasses = [], []
+    for start, cls in zip(starts, rangeclass):
+        if not mclasses or mclasses[-1] != cls:
+            mstarts.append(start)
+            mclasses.append(cls)
+    return mstarts, mclasses, members
+
+def contains(s, c):
+    i = bisect_right(s, (c, MAXCHAR + 1)) - 1
+    return i >= 0 and s[i][0] <= c <= s[i][1]
+
+class DFA(object):
+    ''' A minimized DFA over character classes, for tokens (order, regex)
+        where order says which token wins when two match the same text: the
+        lowest. State 0 is the start; trans[state][cls] is the next state,
+        or -1 when there is none; accept[state] is the order of the token a
+        match ending there is, or None; reach[state] is the lowest order
+        accepted from there on, or None.
+    '''
+    def __init__(self, tokens, extra=(), ascii=False):
+        # extra are more sets of code points to keep apart in the classes;
+        # self.extra gives the classes each holds. With ascii, the regexes
+        # are read as bytepattern() gives them.
+        nfa = NFA()
+        start = nfa.state()
+        for order, regex in tokens:
+            s = nfa.state()
+            nfa.epsilon[start].append(s)
+            nfa.accept.setdefault(nfa.build(RegexParser(regex, ascii=ascii).parse(), s), order)
+
+        sets = []
+        setids = {}
+        for moves in nfa.moves:
+            for s, t in moves:
+                key = tuple(s)
+                if key not in setids:
+                    setids[key] = len(sets)
+                    sets.append(s)
+        self.starts, self.classes, members = partition(sets + list(extra))
+        self.extra = members[len(sets):]
+        self.nclasses = max(self.classes) + 1
+        moves = [[(members[setids[tuple(s)]], t) for s, t in m] for m in nfa.moves]
+
+        # subset construction
+        first = nfa.closure([start])
+        ids = {first: 0}
+        todo = deque([first])
+        trans = []
+        accept = []
+        while todo:
+            states = todo.popleft()
+            orders = [nfa.accept[s] for s in states if s in nfa.accept]
+            accept.append(min(orders) if orders else None)
+            row = []
+            for cls in range(self.nclasses):
+                targets = [t for s in states for classes, t in moves[s] if cls in classes]
+                if not targets:
+                    row.append(-1)
+                    continue
+                target = nfa.closure(targets)
+                if target not in ids:
+                    ids[target] = len(ids)
+                    todo.append(target)
+                row.append(ids[target])
+            trans.append(row)
+        self.trans, self.accept = self.minimize(trans, accept)
+        self.reach = self.reaches()
+
+    def minimize(self, trans, accept):
+        # Merge states no input can tell apart: start from the states
+        # grouped by what they accept, and split groups until every state
+        # in one moves to the same groups
+        group = [accept.index(a) for a in accept]
+        while True:
+            sigs = {}
+            new = []
+            for state, row in enumerate(trans):
+                sig = (group[state],) + tuple(group[t] if t >= 0 else -1 for t in row)
+                new.append(sigs.setdefault(sig, len(sigs)))
+            if len(sigs) == len(set(group)):
+                break
+            group = new
+        # renumber with the start state first
+        order = {}
+        for state in range(len(trans)):
+            order.setdefault(new[state], len(order))
+        mtrans = [None] * len(order)
+        maccept = [None] * len(order)
+        for state, row in enumerate(trans):
+            g = order[new[state]]
+            mtrans[g] = tuple(order[new[t]] if t >= 0 else -1 for t in row)
+            maccept[g] = accept[state]
+        return mtrans, maccept
+
+    def reaches(self):
+        # For each state, the lowest order accepted there or in any state
+        # after it, or None: once that is above the order of a token already
+        # matched, scanning on can't find one declared before it
+        reach = list(self.accept)
+        changed = True
+        while changed:
+            changed = False
+            for state, row in enumerate(self.trans):
+                for t in row:
+                    if t >= 0 and reach[t] is not None and (reach[state] is None or reach[t] < reach[state]):
+                        reach[state] = reach[t]
+                        changed = True
+        return reach
+
+    def firstclasses(self):
+        # Classes a match can start with
+        return set(cls for cls, t in enumerate(self.trans[0]) if t >= 0)
+
+def bytepattern(regex):
+    # regex as re reads it in a bytes pattern: LEXPATTERN.encode() makes
+    # each character its UTF-8 bytes, each read as the code point of that
+    # value. Parse it with ascii for the classes a bytes pattern has.
+    return regex.encode().decode('latin-1')
+
+def longest(regex, ascii=False):
+    # Whether re's match of regex is always the longest it can make, so
+    # the DFA's longest match of it is the one re would take. True of a
+    # sequence of characters, classes and repeats of them, each repeat
+    # having no character in common with what can start the rest: the
+    # input then never gives a repeat a choice between taking another
+    # character and leaving it to what follows.
+    node = RegexParser(regex, ascii=ascii).parse()
+    items = node[1] if node[0] == 'cat' else [node]
+    for k, item in enumerate(items):
+        if item[0] == 'set':
+            continue
+        if item[0] != 'repeat' or item[1][0] != 'set':
+            return False
+        first, nullable = firstof(('cat', items[k+1:]))
+        if overlaps(item[1][1], first):
+            return False
+    return True
+
+class TailParser(RegexParser):
+    # RegexParser, lenient, for tailpattern(): a class is kept as its text
+    # ('text', source), a group as ('group', number, node), a backreference
+    # as ('backref', number), an anchor or other assertion as ('assert',),
+    # and a lazy repeat as ('lazy', node, min, max). The node of each group
+    # is kept by its number.
+    def __init__(self, regex):
+        RegexParser.__init__(self, regex, True)
+        self.groups = {}
+
+    def atom(self):
+        start = self.i
+        number = None
+        if self.peek() == '(' and (self.regex[self.i+1:self.i+2] != '?' or self.regex[self.i+2:self.i+3] == 'P'):
+            number = len(self.groups) + 1
+            self.groups[number] = None
+        elif self.peek() in ('^', '$'):
+            self.take()
+            return ('assert',)
+        node = RegexParser.atom(self)
+        text = self.regex[start:self.i]
+        if number is not None:
+            self.groups[number] = node
+            return ('group', number, node)
+        if node[0] == 'set':
+            return ('text', text)
+        elif node[0] == 'unknown':
+            return ('backref', int(text[1:])) if text[1:].isdigit() else ('assert',)
+        return node
+
+    def repeat(self, node, low, high, lazy):
+        return ('lazy' if lazy else 'repeat', node, low, high)
+
+ANYTHING = '[\\s\\S]*'
+NOTHING = '(?!)'
+
+def tailpattern(regex):
+    # A regex matching what can be read of a match of regex before the end
+    # of a buffer cuts it short: every string that starts a match, the
+    # empty one included, or a few more. Anchored to the end of a buffer, a
+    # match means a token might be cut short there. Of a lazy repeat in the
+    # sequence of the whole regex, only as much is taken as re would, up to
+    # where what follows it matches.
+    try:
+        parser = TailParser(regex)
+        node = parser.parse()
+    except Unsupported:
+        return ANYTHING
+    return Tail(parser.groups).tail(node, True)
+
+class Tail(object):
+    # Builds tailpattern()'s regex from a TailParser tree. A group of the
+    # whole regex's sequence that a later backreference needs is captured
+    # where it is matched whole, and captures maps its number to the
+    # number it has there; no other groups are kept.
+    def __init__(self, groups):
+        self.groups = groups
+        self.captures = {}
+
+    def tail(self, node, top=False):
+        # The strings that start a match of node, as a regex; top if node
+        # ends the whole regex
+        kind = node[0]
+        if kind == 'text':
+            return '(?:{})?'.format(node[1])
+        elif kind == 'group':
+            return self.tail(node[2], top)
+        elif kind == 'backref':
+            # a string the group's pattern matches
+            group = self.groups.get(node[1])
+            return self.tail(group) if group else ANYTHING
+        elif kind == 'assert':
+            return ''
+        elif kind == 'cat':
+            return self.cat(node[1], top)
+        elif kind == 'alt':
+            return '(?:{})'.format('|'.join(self.tail(item, top) for item in node[1]))
+        elif kind == 'lazy' and top:
+            return self.lazy(node, '', '')
+        item, low, high = node[1:]
+        if high == 0:
+            return ''
+        if item[0] == 'text':
+            # a run of one class: any number of them, up to high
+            return '(?:{}){{0,{}}}'.format(item[1], '' if high is None else high)
+        return '(?:{}){{0,{}}}{}'.format(self.whole(item), '' if high is None else high - 1, self.tail(item))
+
+    def cat(self, items, top):
+        if top:
+            # number the groups to capture, in the order they come
+            needed = set(n for item in items for n in backrefs(item))
+            for item in items:
+                if item[0] == 'group' and item[1] in needed:
+                    self.captures[item[1]] = len(self.captures) + 1
+        out = ''  # the tail of what follows
+        rest = ''  # what follows, as a regex that matches no more than it does
+        for k, item in enumerate(reversed(items)):
+            if item[0] == 'lazy' and top:
+                out = self.lazy(item, rest, out)
+            elif k == 0:
+                out = self.tail(item)
+            else:
+                whole = self.whole(item)
+                if item[0] == 'group' and item[1] in self.captures and top:
+                    whole = '({})'.format(whole)
+                out = '(?:{}|{}{})'.format(self.tail(item), whole, out)
+            rest = self.whole(item, True) + rest
+        return out
+
+    def lazy(self, node, rest, resttail):
+        # tail() of a lazy repeat followed by rest, whose own tail is
+        # resttail: past its minimum, the repeat only goes on where rest
+        # doesn't match
+        item, low, high = node[1:]
+        x, tx = self.whole(item), self.tail(item)
+        out = '(?:{}){{{}}}(?:(?!{}){}){{0,{}}}(?:(?!{}){}|{})'.format(
+            x, low, rest, x, '' if high is None else high - low, rest, tx, resttail)
+        if low:
+            out = '(?:(?:{}){{0,{}}}{}|{})'.format(x, low - 1, tx, out)
+        return out
+
+    def whole(self, node, under=False):
+        # node as a regex with no groups of its own. With under, one
+        # matching no more than node does, for a lookahead: a backreference
+        # to a group not captured, or an assertion, then never matches.
+        kind = node[0]
+        if kind == 'text':
+            return node[1]
+        elif kind == 'group':
+            return self.whole(node[2], under)
+        elif kind == 'backref':
+            if under:
+                return '\\{}'.format(self.captures[node[1]]) if node[1] in self.captures else NOTHING
+            group = self.groups.get(node[1])
+            return self.whole(group) if group else ANYTHING
+        elif kind == 'assert':
+            return NOTHING if under else ''
+        elif kind == 'cat':
+            return ''.join(self.whole(item, under) for item in node[1])
+        elif kind == 'alt':
+            return '(?:{})'.format('|'.join(self.whole(item, under) for item in node[1]))
+        item, low, high = node[1:]
+        return '(?:{}){{{},{}}}'.format(self.whole(item, under), low, '' if high is None else high)
+
+def backrefs(node):
+    # The group numbers node refers back to
+    kind = node[0]
+    if kind == 'backref':
+        return [node[1]]
+    elif kind in ('cat', 'alt'):
+        return [n for item in node[1] for n in backrefs(item)]
+    elif kind == 'group':
+        return backrefs(node[2])
+    elif kind in ('repeat', 'lazy'):
+        return backrefs(node[1])
+    return []
+
+def firstset(regex, ascii=False):
+    # Code points a match of regex can start with, or None if that isn't
+    # known (or regex can match the empty string)
+    try:
+        node = RegexParser(regex, True, ascii).parse()
+    except Unsupported:
+        return None
+    first, nullable = firstof(node)
+    return None if nullable else first
+
+def firstof(node):
+    # (first set or None for unknown, can be empty)
+    kind = node[0]
+    if kind == 'unknown':
+        return None, True
+    if kind == 'set':
+        return node[1], False
+    elif kind == 'cat':
+        sets = []
+        for item in node[1]:
+            first, nullable = firstof(item)
+            if first is None:
+                return None, True
+            sets.append(first)
+            if not nullable:
+                return union(*sets), False
+        return union(*sets), True
+    elif kind == 'alt':
+        sets = []
+        nullable = False
+        for item in node[1]:
+            first, empty = firstof(item)
+            if first is None:
+                return None, True
+            sets.append(first)
+            nullable |= empty
+        return union(*sets), nullable
+    first, nullable = firstof(node[1])
+    return first, nullable or node[2] == 0
@@ -1,48 +1,25 @@
-from stock import GOBJ
-import re
+from stock import GOBJ, PCLASS, TABLEDRIVER, TABLERECOGNIZER, VALIDATE
+from stock import EVENTPARSER, TABLEEVENTS, ITERPARSE, PARSEITER
+from stock import CONTEXTLEXER, CONTEXTUAL, OPTIMIZED, PROFILING
+from dfa import DFA, RegexParser, Unsupported, bytepattern, firstset, longest, tailpattern, union
+from bisect import bisect_right
+import re, sys, ast
 from itertools import count
+from collections import deque
 
 log = False
+DISPATCH = 4  # alternatives from which a rule dispatches on a dict (see Emitter.branch)
+INLINE = 4  # terms up to which a rule used more than once is inlined (see Emitter.findinlines)
 
-class GrammarTerm(object):
-    def __init__(self):
-        self.endOf = set()  # productions this term ends (for follow set)
-        # Keep track of which Terminals and Nonterminals follow this one;
-        # used to compute the follow set
-        self.followers = set()
-
-    def findfollows(self):
-        follow = set()
-        for x in self.endOf:
-            if x != self:
-                self.followers.update(x.follow)
-        for x in self.followers:
-            follow.update(set(y for y in x.first if y))
-        return follow
-
-class Terminal(GrammarTerm):
+class Terminal(object):
     def __init__(self, name, pattern):
-        super().__init__()
         self.name = name
         self.pattern = re.compile(pattern)
-        self._follow = None
-        self.compiled = True
 
     @property
     def first(self):
         return set((self,))  # the terminal is a first token
 
-    @property
-    def follow(self):
-        if self._follow:
-            return self._follow
-        follow = self.findfollows()
-        self._follow = follow
-        return self._follow
-
-    def compile(self, caller=None):
-        return
-
     def __call__(self, token):
         # See if the given token matches this terminal
         if log:
@@ -55,15 +32,11 @@ class Terminal(GrammarTerm):
     def __repr__(self):
         return "{}:{}".format(self.name, self.pattern.pattern)
 
-class Nonterminal(GrammarTerm):
+class Nonterminal(object):
     def __init__(self, name):
-        super().__init__()
         self.name = name
         self.productions = []
         self._first = set()
-        self._follow = set()
-        self.compiled = False
-        self.top = False
         self.rules = []  # will eventually hold tuples of (first-set, production) for parsing
 
     def addProduction(self, prod):
@@ -71,56 +44,9 @@ class Nonterminal(GrammarTerm):
 
     @property
     def first(self):
-        if self._first:
-            return self._first
-        first = set()
-        if isinstance(self, Set):
-            for prod in self.productions:
-                for p in prod.prod:
-                    first.update(p.first)
-        else:
-            for prod in self.productions:
-                first.update(prod.first)
-        self._first = first
-        return first
-
-    @property
-    def follow(self):
-        if self._follow:
-            return self._follow
-        if self.top:
-            self._follow.add(Terminal('EOF', r'\Z'))  # end of input terminal
-        if log:
-            print("Follow of ", self, self._follow)
-        self._follow.update(self.findfollows())
-        if self in self.followers:
-            self.followers.remove(self)
-        for f in self.followers:
-            if log:
-                print("Getting first set of {}: {}".format(f, f.first))
-            self._follow.update(set(x for x in f.first if x))
-        if log:
-            print(self._follow, '\n')
-        return self._follow
-
-    def root(self):
-        # This nonterminal is the top level (start) symbol
-        # Add EOF to its follow set
-        # print("Root called on ", self)
-        try:
-            self.compile()
-            self.top = True
-        except RecursionError as e:
-            print("RecursionError: Are you sure your grammar has no left-recursion?")
-            sys.exit(1)
-
-    def compile(self, caller=None):
-        if self.compiled:
-            return
-        self.compiled = True
-        for prod in self.productions:
-            if prod != caller:
-                prod.compile()
+        # the Terminals this can start with, and None if it can be empty
+        # (see Grammar)
+        return self._first
 
     def __str__(self):
         return "{}".format(self.name)
@@ -131,7 +57,7 @@ class Nonterminal(GrammarTerm):
 class Production(object):
     ''' A Production is an ordered list of terms (Terminals and Nonterminals).
         All terms should already exist before declaring Productions.
-        Once all Productions exist, one can compute first then follow sets.
+        Once all Productions exist, Grammar computes their first sets.
     '''
 
     def __init__(self, head, *args):
@@ -139,88 +65,190 @@ class Production(object):
         # args should be a sequence of Nonterminals and Terminals
         # Null production represents epsilon
         self.prod = args
-        self._first = None
-        self._follow = set()
+        self._first = set()
         self.head = head
         self.head.addProduction(self)
-        self.compiled = False
         self.pclass = None
 
-        #print(head, type(head), args, [type(x) for x in args])
-
-        # Note which terms follow which
-        for i,arg in enumerate(args):
-            if i < len(args)-1:
-                arg.followers.add(args[i+1])
-        # Still might have other terms at end of this if last -> epsilon,
-        # but we can't check for that until we have the first sets.
-        # Do that in function updateEnds()
-
     @property
     def first(self):
-        if self._first:
-            return self._first
-        # otherwise, compute first set
-        if not self.prod[0]:  # epsilon
-            return set((None,))
-        first = set()
-        for term in self.prod:
-            fs = term.first
-            if None not in fs:  # we can stop here
-                first.update(fs)
-                self._first = first
-                return first
-            else:  # nonterminal could be epsilon, so keep going
-                first.update(set(x for x in fs if x))  # add everything but epsilon
-        self._first = first
-        return first
-
-    def updateEnds(self):
-        # Call this function after firsts are done, but before follows
-        if not self.prod[0]:
-            return  # epsilon
-        self.prod[-1].endOf.add(self.head)  # tell terms when they end productions
-        last = 0
-        finding = True  # find term that reflects productions follow set
-        for i, arg in enumerate(reversed(self.prod)):
-            if None in arg.first and i < len(self.prod)-1:
-                # if a term can go to epsilon, then the one before it gets its follow set
-                term = self.prod[i+1]
-                term.followers.update(arg.followers)
-                term.endOf.update(arg.endOf)
-                if finding:
-                    last += 1
-            else:
-                finding = False
-        self.last = len(self.prod) - last
-
-    def compile(self):
-        # Do some booking needed before follow sets can be computed, and build
-        # a map of terminal_list -> production
-        if self.compiled:
-            return
-        self.compiled = True
-
-        self.head.rules.append((self.first, self))
-
-        if not self.prod[0]:
-            return  # epsilon
-        self.updateEnds()
-        for t in self.prod:
-            t.compile(self)
-
-    @property
-    def follow(self):
-        # Call only after grammar is finished and all followers have been added
-        if self._follow:
-            return self._follow
-        term = self.prod[self.last]
-        self._follow = term.follow
-
+        return self._first
 
     def __str__(self):
         return "{} => {}".format(self.head, ' '.join(map(str, self.prod)))
 
+def closure(sets, deps):
+    # Union each of sets with those of the numbers in its deps, and theirs
+    # in turn: DeRemer and Pennello's digraph algorithm, which walks the
+    # deps depth first and gives each strongly connected group of them one
+    # shared set, so each set is unioned in once however the deps nest
+    done = len(sets) + 1  # depth of a number whose set is final
+    depth = [0] * len(sets)
+    stack = []
+    for start in range(len(sets)):
+        if depth[start]:
+            continue
+        stack.append(start)
+        depth[start] = len(stack)
+        work = [(start, len(stack), iter(deps[start]))]
+        while work:
+            x, d, rest = work[-1]
+            y = next(rest, None)
+            if y is not None:
+                if not depth[y]:
+                    stack.append(y)
+                    depth[y] = len(stack)
+                    work.append((y, len(stack), iter(deps[y])))
+                    continue
+                depth[x] = min(depth[x], depth[y])
+                sets[x] |= sets[y]
+                continue
+            work.pop()
+            if depth[x] == d:
+                while True:
+                    y = stack.pop()
+                    depth[y] = done
+                    sets[y] = sets[x]
+                    if y == x:
+                        break
+            if work:
+                parent = work[-1][0]
+                depth[parent] = min(depth[parent], depth[x])
+                sets[parent] |= sets[x]
+    return sets
+
+class Grammar(object):
+    ''' The rules of a grammar, indexed for analysis: each Nonterminal is
+        numbered, those reachable from the root first in the order they are
+        found, and each has the list of the rules its first set takes in.
+        First sets are found by closure over those lists rather than by
+        recursion, so the time taken grows with the size of the grammar and
+        not with how deeply its rules nest.
+
+        A term can be empty, as far as first sets go, if it is a rule with
+        an empty production (an Optional's included), or a Set with a
+        choice that can be. A Repeat, or a production of terms that can
+        all be empty, doesn't count; Emitter.nullable has the Repeats.
+    '''
+
+    def __init__(self, root, others=()):
+        self.terms = []  # Nonterminals by number
+        self.index = {}  # maps Nonterminal to its number
+        self.reach([root])
+        self.nonterminals = self.terms[:]  # reachable Nonterminals, breadth first from the root
+        self.reach(others)  # rules not reachable still get first sets, for their parse functions
+        self.empty = self.findempty()
+        self.leads = []  # the numbers of the rules each one's first set takes in
+        self.findfirst()
+        self.checkleft()
+
+    def reach(self, roots):
+        # Number the Nonterminals reachable from roots not numbered yet
+        queue = deque(roots)
+        while queue:
+            nt = queue.popleft()
+            if nt in self.index:
+                continue
+            self.index[nt] = len(self.terms)
+            self.terms.append(nt)
+            for prod in nt.productions:
+                for term in prod.prod:
+                    if isinstance(term, Nonterminal) and term not in self.index:
+                        queue.append(term)
+
+    def choices(self, nt):
+        # The terms a Set chooses between
+        return [term for prod in nt.productions for term in prod.prod]
+
+    def findempty(self):
+        # The Nonterminals that can be empty: those with an empty production,
+        # and, passed on to the Sets choosing them, Sets with one that can be
+        empty = set(nt for nt in self.terms if not isinstance(nt, Set)
+                    and any(not prod.prod[0] for prod in nt.productions))
+        sets = [[] for nt in self.terms]  # Sets choosing each Nonterminal
+        for nt in self.terms:
+            if isinstance(nt, Set):
+                for term in self.choices(nt):
+                    if isinstance(term, Nonterminal):
+                        sets[self.index[term]].append(nt)
+        queue = deque(empty)
+        while queue:
+            for nt in sets[self.index[queue.popleft()]]:
+                if nt not in empty:
+                    empty.add(nt)
+                    queue.append(nt)
+        return empty
+
+    def leading(self, nt):
+        # The terms nt's first set takes in: each of a Set's choices, and
+        # the terms productions start with, up to and including the first
+        # that can't be empty
+        if isinstance(nt, Set):
+            return self.choices(nt)
+        terms = []
+        for prod in nt.productions:
+            for term in prod.prod:
+                if term is None:
+                    break
+                terms.append(term)
+                if term not in self.empty:
+                    break
+        return terms
+
+    def findfirst(self):
+        # First sets of all the Nonterminals, and of their productions, and
+        # the (first set, production) rules each is parsed with
+        first = [set() for nt in self.terms]  # Terminals each can start with
+        leads = self.leads = [[] for nt in self.terms]  # the rules whose first sets each takes in
+        for i, nt in enumerate(self.terms):
+            for term in self.leading(nt):
+                if isinstance(term, Terminal):
+                    first[i].add(term)
+                else:
+                    leads[i].append(self.index[term])
+        closure(first, leads)
+
+        for i, nt in enumerate(self.terms):
+            nt._first = first[i] | set((None,)) if nt in self.empty else set(first[i])
+        for nt in self.terms:
+            for prod in nt.productions:
+                if not prod.prod[0]:
+                    prod._first = set((None,))  # epsilon
+                    continue
+                prod._first = set()
+                for term in prod.prod:
+                    prod._first.update(term.first)
+                    if term not in self.empty:
+                        break
+                prod._first.discard(None)
+        for nt in self.nonterminals:
+            nt.rules = [(prod.first, prod) for prod in nt.productions]
+
+    def checkleft(self):
+        # Raise an exception naming a cycle of rules that each start with
+        # the next, which recursive descent would loop on forever
+        leads = self.leads
+        state = [0] * len(self.terms)  # 1 while being searched, 2 once done
+        for start in range(len(self.terms)):
+            if state[start]:
+                continue
+            state[start] = 1
+            path = [start]
+            stack = [iter(leads[start])]
+            while stack:
+                i = next(stack[-1], None)
+                if i is None:
+                    state[path.pop()] = 2
+                    stack.pop()
+                elif state[i] == 1:
+                    cycle = path[path.index(i):] + [i]
+                    raise Exception("Left recursion, which can't be parsed by recursive descent: {}".format(
+                        ' -> '.join(self.terms[x].name for x in cycle)))
+                elif state[i] == 0:
+                    state[i] = 1
+                    path.append(i)
+                    stack.append(iter(leads[i]))
+
 class Operator(Nonterminal):
     def __init__(self, name, *args):
         super().__init__(name)
@@ -240,58 +268,60 @@ class Optional(Operator):
         self.optype = "Optional"
 
 class Emitter(object):
-    def __init__(self, tree):#, grammar):
+    def __init__(self, tree, table=False, loops=False, dfa=False, contextual=False, optimize=False, inline=False,
+                 instrument=False, profile=None):#, grammar):
         self.tree = tree  # parse tree made of lists
+        self.table = table  # emit a table-driven parser instead of parse functions
+        self.loops = loops  # parse tail-recursive list rules with loops
+        self.dfa = dfa  # lex str input with a DFA compiled from the tokens
+        self.contextual = contextual  # lex only the tokens the parser expects
+        self.follow = {}  # maps Nonterminal to the Terminals that can follow it
+        self.grammar = None  # reachable rules and their first sets (see Grammar)
+        self.nonterminals = []  # the Nonterminals of the grammar, in order found from the root
+        self.optimize = optimize  # -O: no logging checks, and one lookahead read per choice
+        self.traced = []  # (function, rule, parameters, arguments) for TracedParser
+        self.inline = inline  # splice small and single-use rules into the productions using them
+        self.inlined = set()  # Nonterminals spliced in rather than called
+        self.instrument = instrument  # --profile: count the productions taken in PROFILE
+        self.profiled = {}  # maps rule name to the number of productions counted for it
+        self.profile = profile or {}  # --profile-data: maps rule name to how often each production was taken
         self.start = None  # name of root grammar rule
         self.parser = ''  # build up parser classes/functions here
         self.objs = GOBJ  # put named class definitions here
         self.tokenmap = {}  # maps string to Terminal object
         self.namemap = {}  # maps string to Nonterminal object
         self.operators = []  # maps string name to Operator object
+        self.precedence = {}  # maps token name to (level, associativity)
+        self.binops = {}  # maps nonterminal name to its (operator, binding) productions
+        self.classes = {}  # maps node class name to its list of fields
+        self.shapes = {}  # maps node class name to the field tuples it's bound with
         self.lexmap = []  # (name, regex) pairs for lexer
+        self.ignore = []  # (name, regex) pairs the lexer skips
+        self.kinds = {}  # maps token name to integer token kind
+        self.kindconsts = {}  # maps token kind to its module-level constant
+        self.keywords = {}  # maps token kind to the (text, kind) keywords it matches
+        self.tokensets = {}  # maps tuple of token kinds to frozenset constant
+        self.toksetnames = {}  # maps frozenset of Terminals to frozenset constant
+        self.consts = []  # module-level lookahead sets go here, joined once all are made
         self.itercount = count(0)  # need unique number for anonymous variables
 
     def count(self):
         return next(self.itercount)
 
-    def findterms(self, root):
-        # Find the terminals, nonterminals, and productions in the grammar
-        # Requires root grammar nonterminal
-        nonterms = []
-        prods = []
-        terms = []
-        stack = [root, ]
-        seen = set()
-        while stack:
-            term = stack.pop(0)
-            if term in seen:
-                continue
-            seen.add(term)
-            nonterms.append(term)
-            for prod in term.productions:
-                prods.append(prod)
-                for item in prod.prod:
-                    if isinstance(item, Nonterminal):
-                        stack.append(item)
-                    elif isinstance(item, Terminal):
-                        terms.append(item)
-        self.nonterminals = nonterms
-        #self.productions = prods
-        #self.terminals = terms
-
-
     def emit(self):
         #print("emit", self.tree)
 
         tree = self.tree
         rootdecl = tree[0]
         toktree = tree[1]
-        grammars = tree[2]
+        prectree = tree[2]
+        grammars = tree[3]
         assert(rootdecl[0] == "%root")
         assert(toktree[0] == "%tokens")
         assert(grammars[0] == "%grammar")
         root = rootdecl[1]
         self.gettokens(toktree)
+        self.getprecedence(prectree)
 
         tree = grammars[1]
         self.start = tree.decl.dname  # save root rule for parsing
@@ -321,41 +351,155 @@ class Emitter(object):
             #         self.allmap[nt.name] = nt
             #         p = Production(self.namemap[term.arg[0]], *[allmap[x] for x in term.args[1:]])
 
+            if len(args) == 3 and args[0] == name and args[2] == name:
+                # N := N op N is parsed by precedence climbing (see emitpratt)
+                self.binops.setdefault(name, []).append((args[1], binding))
+                continue
             x = Production(self.namemap[name], *[allmap[x] for x in args])
             if binding:
-                s = ''
-                s += "class {}(GrammarObj):\n".format(binding[0])
-                s += "    def __init__(self, *args):\n"
-                s += "        super().__init__(*args)\n"
-                s += "        self.name = \"{}\"\n".format(binding[0])
-                # for i,b in enumerate(binding[1:]):
-                #     s += "        self.{} = args[{}]\n".format(b, i)
-                self.objs += s + '\n'
                 x.pclass = binding
             else:
                 x.pclass = None
 
-        # Emit lexer map
+        # Find all the nonterminals, and the node classes they build
+        root = self.namemap[self.start]
+        self.grammar = Grammar(root, self.namemap.values())
+        self.nonterminals = self.grammar.nonterminals
+        self.findclasses()
+        if self.inline and not self.table:
+            self.inlined = self.findinlines()
+        self.objs += ''.join(self.emitclass(name, fields) for name, fields in self.classes.items())
+        self.objs += "NODES = {{\n{}}}\n\n".format(''.join(
+            "    '{}': {},\n".format(name, tuple(fields)) for name, fields in self.classes.items()))
+        self.parser += "    # Node classes, reached through the parser so a builder can replace them\n"
+        for name in self.classes:
+            self.parser += "    {} = {}\n".format(name, name)
+        self.parser += "\n"
+
+        # Emit lexer map and the integer kind of each token
         self.objs += "LEXMAP = {}\n\n".format(self.lexmap).replace('\\\\','\\')
+        self.objs += "IGNORE = {}\n\n".format(self.ignore).replace('\\\\','\\')
+        self.objs += self.emitkinds()
+        self.objs += self.emitkeywords()
+        self.objs += self.emittails()
+        self.objs += self.emitdfa()
+        if self.contextual:
+            self.follow = self.follows()
+            self.objs += self.emitliterals() + CONTEXTLEXER
+
+        # Make a parse function for each nonterminal
+        if self.table:
+            tables = self.emittable()
+        else:
+            self.parser += ''.join(self.emitpratt(nt) if nt.name in self.binops else self.emitfunc(nt)
+                                   for nt in self.nonterminals)
 
-        # Find all the nonterminals and make a parse function for each
-        root = self.namemap[self.start]
-        root.compile()
-        self.findterms(self.namemap[self.start])
-        for nt in self.nonterminals:
-            self.emitfunc(nt)
+        if self.instrument:
+            self.consts.append("# rule -> how often each of its productions has been taken\n")
+            self.consts.append("PROFILE = {{\n{}}}\n".format(''.join(
+                "    \"{}\": {},\n".format(rule, [0] * size) for rule, size in self.profiled.items())))
+        self.objs += ''.join(self.consts) + '\n'
 
         s = ''
         s += "    def _parseRoot(self):\n"
-        s += "        return self.parse{}()\n\n".format(root)
+        if self.table:
+            self.objs += tables
+            s += "        return self.parsetable(0)\n\n"
+        else:
+            s += "        return self.parse{}()\n\n".format(root)
+        s += self.emititer()
+        if self.optimize:
+            s += OPTIMIZED
+        if self.contextual:
+            s += CONTEXTUAL
         self.parser += s
+        self.parser += PARSEITER
+        if self.optimize:
+            self.parser += self.emittraced()
+        self.parser += self.emitrecognizer()
+        self.parser += self.emitevents()
+        if self.instrument:
+            self.parser += PROFILING
+
+    def emititer(self):
+        # Parser._iterRoot for parse_iter: find the list the root rule is,
+        # going through rules that are just another rule (Program :=
+        # Statements), and yield its items one at a time. The list is a rule
+        # like Decls := Decl Decls | $ (see islist), whose items are its
+        # productions less the recursive call, built as with --loops; or a
+        # rule like Statements := Statement [Statement]. Any other root is
+        # yielded whole, as the one item.
+        nt = self.namemap[self.start]
+        seen = set()
+        while nt not in seen and len(nt.rules) == 1 and nt.name not in self.binops:
+            seen.add(nt)
+            prod = nt.rules[0][1].prod
+            if len(prod) != 1 or not isinstance(prod[0], Nonterminal) or isinstance(prod[0], Operator):
+                break
+            nt = prod[0]
+
+        s = ''
+        s += "    def _iterRoot(self):\n"
+        if self.islist(nt) and nt.name not in self.binops:
+            s += "        # items of {}\n".format(nt.name)
+            s += "        while True:\n"
+            for first, production in nt.rules:
+                if not production.prod[0]:
+                    continue
+                s += "            if {} {}:\n".format(self.peek(self.expected(nt)), self.lookahead(first))
+                variables = []
+                for i,term in enumerate(production.prod[:-1]):
+                    variables.append("var{}_{}".format(i, sanitize(term.name)))
+                    s += "                {} = {}\n".format(variables[-1], self.value(term))
+                if self.loops and production.pclass:
+                    s += "                yield {}\n".format(self.construct(production.pclass, variables))
+                elif len(variables) == 1:
+                    s += "                yield {}\n".format(variables[0])
+                else:
+                    s += "                yield ({})\n".format(', '.join(variables))
+                s += "                continue\n"
+            s += "            return\n\n"
+            return s
+
+        # Statement [Statement], or [Statement] alone
+        item = None
+        prod = nt.rules[0][1].prod if len(nt.rules) == 1 else (None,)
+        if isinstance(nt, Repeat):
+            prod = (nt,)
+        for term in prod:
+            if isinstance(term, Repeat):
+                term = term.rules[0][1].prod[0]
+            if term is None or (item is not None and term != item):
+                break
+            item = term
+        else:
+            s += "        # items of {}\n".format(nt.name)
+            for term in prod:
+                if isinstance(term, Repeat):
+                    s += "        while {} {}:\n".format(self.peek(self.expected(term)), self.lookahead(term.rules[0][0].difference(set((None,)))))
+                    s += "            yield {}\n".format(self.value(item))
+                else:
+                    s += "        yield {}\n".format(self.value(item))
+            s += "\n"
+            return s
+
+        s += "        yield self._parseRoot()\n\n"
+        return s
+
+    def value(self, term):
+        # Source parsing term and giving its value
+        if isinstance(term, Terminal):
+            return "self.consume({})".format(self.kind(term))
+        elif self.table:
+            return "self.parsetable({})".format(self.grammar.index[term])
+        return "self.{}()".format(fname(sanitize(term.name)))
 
     def emitdecl(self, decl):
         name = decl.dname
         alt = decl.alt
         alts = decl.alts
 
-        if any([x(name) for x in self.tokenmap.values()]):  # see if name is token
+        if name in self.tokenmap:  # see if name is token
             pass
         elif name not in self.namemap:  # otherwise, it's a nonterminal
             self.namemap[name] = Nonterminal(name)
@@ -431,14 +575,14 @@ class Emitter(object):
             if arg[0] in ("'", "\""):
                 val = arg[1:-1]
                 # print(arg, val)
-                if any([x(val) for x in self.tokenmap.values()]):
+                if val in self.tokenmap:
                     continue
                 else:
                     self.tokenmap[val] = Terminal(val, val)
                     self.tokenmap[arg] = Terminal(val, val)
                     self.lexmap.append((val, val))
             else:  # name
-                if any([x(arg) for x in self.tokenmap.values()]):  # see if name is token
+                if arg in self.tokenmap:  # see if name is token
                     continue
                 if arg not in self.namemap:  # otherwise, it's a nonterminal
                     self.namemap[arg] = Nonterminal(arg)
@@ -466,17 +610,335 @@ class Emitter(object):
             return [name, ]
 
     def gettokens(self, toktree):
-        pairs = toktree[1]
+        for name, regex in self.getpairs(toktree[1]):
+            self.tokenmap[name] = Terminal(name, regex)
+            self.lexmap.append((name, regex))
+            # print("Regex: ", name, regex)
+        if len(toktree) > 2 and toktree[2]:  # %ignore
+            for name, regex in self.getpairs(toktree[2][1]):
+                self.ignore.append((name, regex))
 
+    def getpairs(self, pairs):
         while pairs:
             name = pairs[0]
             regex = pairs[1]
             pairs = pairs[2]
             regex = regex.strip()[1:-1]
-            self.tokenmap[name] = Terminal(name, regex)
-            self.lexmap.append((name, regex))
-            # print("Regex: ", name, regex)
+            yield name, regex
+
+
+    def findclasses(self):
+        # Collect the fields of each node class from the bindings that will
+        # be built; a name bound to fewer terms than it has is dropped
+        bindings = []
+        for nt in self.nonterminals:
+            loop = self.loops and not self.table and self.islist(nt)
+            for first, production in nt.rules:
+                if production.pclass and production.prod[0]:
+                    # list items are built without the recursive tail
+                    bindings.append((production.pclass, len(production.prod) - loop))
+            for op, binding in self.binops.get(nt.name, ()):
+                if binding:
+                    bindings.append((binding, 3))
+        # names the emitted module and its parsers define, from every
+        # template that can be emitted and the classes written here
+        templates = (GOBJ, PCLASS, TABLEDRIVER, TABLERECOGNIZER, VALIDATE, PARSEITER, EVENTPARSER, TABLEEVENTS,
+                     ITERPARSE, CONTEXTLEXER, CONTEXTUAL, OPTIMIZED, PROFILING)
+        source = ''.join(templates)
+        reserved = set(re.findall(r'def (\w+)\(|self\.(\w+) *[,=]|^ *class (\w+)', source, re.M))
+        reserved = set(x for names in reserved for x in names)
+        for names in re.findall(r'^(\w+(?:, *\w+)*) *=', source, re.M):
+            reserved.update(x.strip() for x in names.split(','))
+        reserved.update(("TracedParser", "Recognizer", "EventParser"))
+        for binding, size in bindings:
+            if binding[0] == "_":
+                continue
+            if binding[0] in reserved:
+                raise Exception("Production name {} clashes with Parser.{}".format(binding[0], binding[0]))
+            shape = tuple(x for x, v in bindpairs(binding[1:size+1], binding[1:size+1]))
+            self.shapes.setdefault(binding[0], set()).add(shape)
+            fields = self.classes.setdefault(binding[0], [])
+            fields += [x for x in shape if x not in fields]
+
+    def emitclass(self, name, fields):
+        # One node class per binding name, holding just its named fields
+        s = ''
+        s += "class {}(GrammarObj):\n".format(name)
+        s += "    __slots__ = ({})\n".format(''.join("'{}', ".format(x) for x in fields).rstrip())
+        if "name" not in fields:
+            s += "    name = \"{}\"\n".format(name)
+        if len(self.shapes[name]) > 1:
+            # bound with different fields by different productions
+            s += "    def __init__(self, {}):\n".format(', '.join(x + "=None" for x in fields))
+        else:
+            s += "    def __init__(self{}):\n".format(''.join(', ' + x for x in fields))
+        for x in fields:
+            s += "        self.{} = {}\n".format(x, x)
+        if not fields:
+            s += "        pass\n"
+        return s + '\n'
+
+    def construct(self, binding, variables, parser="self"):
+        # Source building binding's node from the parsed variables, paired
+        # by bindpairs. Node classes are reached through the parser so
+        # that a builder given to it can stand in for them.
+        pairs = bindpairs(binding[1:], variables)
+        if len(self.shapes[binding[0]]) > 1:
+            args = ', '.join("{}={}".format(x, v) for x, v in pairs)
+        else:
+            args = ', '.join(v for x, v in pairs)
+        return "{}.{}({})".format(parser, binding[0], args)
+
+    def getprecedence(self, prectree):
+        # %left, %right and %nonassoc lines, from lowest precedence to highest
+        level = 0
+        while prectree:
+            decl = prectree.decl
+            level += 1
+            for name in [decl.pname] + self.getnames(decl.names):
+                self.precedence[name] = (level, decl.assoc)
+            prectree = prectree.rest
+
+    def emitkinds(self):
+        # Number the tokens in LEXMAP order and give each a constant, so
+        # generated code compares small integers instead of token names
+        s = ''
+        for i, (name, regex) in enumerate(self.lexmap):
+            const = "TOK_{}".format(sanitize(name))
+            if const == "TOK_" or const in self.kindconsts.values():
+                const = "TOK{}".format(i)
+            self.kinds[name] = i
+            self.kindconsts[i] = const
+            s += "{} = {}\n".format(const, i)
+        s += "TOKNAMES = [name for name, regex in LEXMAP]\n\n"
+        return s
+
+    def tokenregexes(self):
+        # SKIP and LEXMAP, with the regexes as the generated module reads them
+        lexmap = ast.literal_eval("{}".format(self.lexmap).replace('\\\\','\\'))
+        ignore = ast.literal_eval("{}".format(self.ignore).replace('\\\\','\\'))
+        return [('whitespace', '\\s+')] + ignore, lexmap
+
+    def emittails(self):
+        # For each token of SKIP + LEXMAP, a regex matching what can be read
+        # of it before the end of a buffer cuts it short (see tailpattern),
+        # so that a file is only lexed as far as no match could change once
+        # more of it is read
+        skip, lexmap = self.tokenregexes()
+        s = "# what can be read of each token of SKIP + LEXMAP before it is cut short\n"
+        s += "LEXTAILS = [\n{}]\n\n".format(''.join("    {!r},\n".format(tailpattern(regex)) for name, regex in skip + lexmap))
+        return s
+
+    def emitkeywords(self):
+        # A literal token that a later token matches in full, such as 'if'
+        # and name '\w+', is left out of the lexer: the later token is
+        # matched instead, and looked up in KEYWORDS to tell if it's the
+        # literal. Lexing a name then costs one lookup however many keywords
+        # there are, and 'iffy' is no longer lexed as 'if' 'fy'. A literal
+        # is kept if a token declared between the two also matches at its
+        # start, since that one would then be lexed in its place.
+        keywords = self.keywords
+        patterns = []  # compiled regex of each token, None if re can't
+        for name, regex in self.lexmap:
+            try:
+                patterns.append(re.compile(regex))
+            except re.error:
+                patterns.append(None)
+        for i, (name, regex) in enumerate(self.lexmap):
+            text = literal(regex)
+            if not text:
+                continue
+            for j in range(i + 1, len(patterns)):
+                pattern = patterns[j]
+                if pattern is None:
+                    break
+                if literal(self.lexmap[j][1]) is None and pattern.fullmatch(text):
+                    keywords.setdefault(j, []).append((text, i))
+                    break
+                if pattern.match(text):
+                    break
+        s = ''
+        s += "# token kind -> {text: kind} of the literal tokens it also matches\n"
+        s += "KEYWORDS = {\n"
+        for j, words in sorted(keywords.items()):
+            s += "    {}: {{{}}},\n".format(self.kindconsts[j], ', '.join(
+                "{!r}: {}".format(text, self.kindconsts[i]) for text, i in words))
+        s += "}\n\n"
+        return s
+
+    def emitdfa(self):
+        # With --dfa, the tokens dfa.py can compile are lexed by a minimized
+        # DFA rather than the master regex, which takes the token the regex
+        # would: of those matching, the one declared first. The others (lazy
+        # quantifiers, backreferences and so on) are still matched with re,
+        # but only at characters they can start with, and re gives the end
+        # of a token whose match might not be its longest (see longest). One
+        # DFA is built for str input and files, and one for bytes, where \w
+        # and the like are ASCII as in a bytes pattern.
+        if not self.dfa:
+            return "DFATRANS = None\n\n"
+        skip, lexmap = self.tokenregexes()
+        left = set(i + len(skip) for words in self.keywords.values() for text, i in words)
+        dfa, fallback, starts, recheck = self.builddfa(skip + lexmap, left, False)
+        if dfa.nclasses > 256:
+            print("--dfa: {} character classes is too many, lexing with re".format(dfa.nclasses), file=sys.stderr)
+            return "DFATRANS = None\n\n"
+        bytedfa, bytefallback, bytestarts, byterecheck = self.builddfa(skip + lexmap, left, True)
+        ascii = [dfa.classes[bisect_right(dfa.starts, c) - 1] for c in range(128)] + [0] * 128
+        byteclasses = [bytedfa.classes[bisect_right(bytedfa.starts, c) - 1] for c in range(256)]
+        if bytestarts is not None:
+            bytestarts = [c for c in range(256) if byteclasses[c] in bytestarts]
+        kinds = ["-1" if i < len(skip) else self.kindconsts[i - len(skip)]
+                 for i in range(len(skip) + len(lexmap))]
+        s = ''
+        s += "# --dfa: the tokens as one DFA over classes of characters (see dfa.py)\n"
+        s += "DFAKINDS = ({},)  # token order -> kind, -1 (WHITESPACE) if skipped\n".format(', '.join(kinds))
+        s += "DFAASCII = bytes(({},))  # class of each ASCII character\n".format(', '.join(map(str, ascii)))
+        s += "DFASTARTS = {!r}  # first code point of each range in DFACLASSES\n".format(tuple(dfa.starts))
+        s += "DFACLASSES = {!r}\n".format(tuple(dfa.classes))
+        s += "DFANCLASSES = {}\n".format(dfa.nclasses)
+        s += self.emitdfatables("DFA", dfa, fallback, starts, recheck)
+        s += "# the DFA for bytes input, over the classes of each byte\n"
+        s += "DFABYTECLASSES = bytes(({},))\n".format(', '.join(map(str, byteclasses)))
+        s += self.emitdfatables("DFABYTE", bytedfa, bytefallback, bytestarts, byterecheck)
+        return s + "\n"
+
+    def builddfa(self, tokens, left, ascii):
+        # The DFA of the (name, regex) tokens dfa.py can compile, but for
+        # the orders in left; the (order, name, regex) of those left to re;
+        # the classes those can start with, or None if that isn't known; and
+        # the orders of the tokens whose ends re gives. With ascii, the
+        # regexes are read as in a bytes pattern.
+        compiled = []
+        fallback = []
+        recheck = []
+        for order, (name, regex) in enumerate(tokens):
+            if order in left:
+                continue
+            pattern = bytepattern(regex) if ascii else regex
+            try:
+                RegexParser(pattern, ascii=ascii).parse()
+            except Unsupported:
+                fallback.append((order, name, regex))
+                continue
+            compiled.append((order, pattern))
+            if not longest(pattern, ascii):
+                recheck.append(order)
+        firsts = [firstset(bytepattern(regex) if ascii else regex, ascii) for order, name, regex in fallback]
+        known = None not in firsts
+        dfa = DFA(compiled, [union(*firsts)] if known else [], ascii)
+        return dfa, fallback, sorted(dfa.extra[0]) if known else None, recheck
+
+    def emitdfatables(self, prefix, dfa, fallback, starts, recheck):
+        s = ''
+        s += "# state -> next state for each class, or -1\n"
+        s += "{}TRANS = (\n{})\n".format(prefix, ''.join("    {!r},\n".format(row) for row in dfa.trans))
+        s += "{}ACCEPT = {!r}  # state -> order of the token matched, or None\n".format(prefix, tuple(dfa.accept))
+        s += "{}REACH = {!r}  # state -> lowest order accepted from there on, or None\n".format(
+            prefix, tuple(dfa.reach))
+        s += "# (order, name, regex) of the tokens matched with re, and the classes they start with\n"
+        s += "{}FALLBACK = {!r}\n".format(prefix, fallback)
+        s += "{}FALLBACKCLASSES = {}\n".format(prefix, "frozenset({!r})".format(starts) if starts is not None else None)
+        s += "{}RECHECK = {!r}  # orders of the tokens whose ends re gives\n".format(prefix, tuple(recheck))
+        return s
+
+    def emitliterals(self):
+        # The text of each plain-string token, for contextlexer to try longer
+        # ones first
+        s = ''
+        s += "# token kind -> text of the tokens that match just one string\n"
+        s += "LITERALS = {\n"
+        for i, (name, regex) in enumerate(self.lexmap):
+            text = literal(regex)
+            if text:
+                s += "    {}: {!r},\n".format(self.kindconsts[i], text)
+        s += "}\n\n"
+        return s
+
+    def follows(self):
+        # FOLLOW set of each nonterminal, for --contextual: the Terminals that
+        # can come right after it. Each place a nonterminal is used gives it
+        # the tokens that can start what comes after it there, and if that
+        # can be empty, the FOLLOW set of the rule using it, taken in by
+        # closure over the rules
+        index = self.grammar.index
+        follow = [set() for nt in self.grammar.terms]
+        passed = [[] for nt in self.grammar.terms]  # the rules whose FOLLOW sets each takes in
+        for nt in self.nonterminals:
+            after = [(production.prod if production.prod[0] else (), None) for first, production in nt.rules]
+            if isinstance(nt, Repeat):
+                # an item can be followed by the next one
+                after += [(production.prod, production.prod[0].first.difference(set((None,))))
+                          for first, production in nt.rules]
+            for op, binding in self.binops.get(nt.name, ()):
+                after.append(((nt,), set(self.optokens(op, nt))))
+            for prod, trailer in after:
+                # None for the end of the production, which nt's FOLLOW set follows
+                carried = trailer is None
+                trailer = set() if carried else trailer
+                for term in reversed(prod):
+                    if isinstance(term, Nonterminal):
+                        follow[index[term]] |= trailer
+                        if carried:
+                            passed[index[term]].append(index[nt])
+                        first = term.first.difference(set((None,)))
+                        if self.nullable(term):
+                            trailer = trailer | first
+                        else:
+                            trailer, carried = first, False
+                    else:
+                        trailer, carried = set((term,)), False
+        closure(follow, passed)
+        follow = dict((nt, set(follow[index[nt]])) for nt in self.nonterminals)
+        return follow
 
+    def nullable(self, nonterm):
+        return isinstance(nonterm, Repeat) or None in nonterm.first
+
+    def expected(self, nonterm):
+        # The tokens that can be next when nonterm is parsed: those its
+        # productions start with, and if it can be empty, its FOLLOW set
+        terms = nonterm.first.difference(set((None,)))
+        if self.nullable(nonterm) or (self.loops and self.islist(nonterm)):
+            terms |= self.follow.get(nonterm, set())
+        return terms
+
+    def peek(self, terms):
+        # Source reading the lookahead where terms can come next; with
+        # --contextual, only they are tried when it is scanned
+        if not self.contextual:
+            # under -O, the lookahead is read directly: if scanning stopped
+            # short, the next() or consume() that follows fails for it
+            return "self.tok" if self.optimize else "self.next()"
+        elif not terms:
+            return "self.peek(None)"
+        return "self.peek({})".format(self.tokset(terms))
+
+    def tokset(self, terms):
+        # Name of the module-level frozenset holding the kinds of terms
+        terms = frozenset(terms)
+        if terms in self.toksetnames:
+            return self.toksetnames[terms]
+        kinds = tuple(sorted(set(self.kinds[t.name] for t in terms)))
+        if kinds not in self.tokensets:
+            const = "TOKSET{}".format(len(self.tokensets))
+            self.tokensets[kinds] = const
+            self.consts.append("{} = frozenset(({},))  # {}\n".format(
+                const, ', '.join(self.kindconsts[k] for k in kinds),
+                ' '.join(self.lexmap[k][0] for k in kinds)))
+        self.toksetnames[terms] = self.tokensets[kinds]
+        return self.tokensets[kinds]
+
+    def lookahead(self, terms, negate=False):
+        # Test against the lookahead token: one kind is compared directly,
+        # more than one is a membership test on a frozenset
+        kinds = set(self.kinds[t.name] for t in terms)
+        if len(kinds) == 1:
+            return "{} {}".format("!=" if negate else "==", self.kindconsts[kinds.pop()])
+        return "{} {}".format("not in" if negate else "in", self.tokset(terms))
+
+    def kind(self, term):
+        return self.kindconsts[self.kinds[term.name]]
 
     # def emitoperator(self, op):
     #     print(op, op.rules, type(op))
@@ -493,11 +955,12 @@ class Emitter(object):
     #     elif isinstance(op, Set):
     #         pass
 
-    def emitfunc(self, nonterm):
-        s = ''
-        s += "    def {}(self):\n".format(fname(nonterm.name))
-        s += "        if self.log:\n"
-        s += "            print(\"{}\")\n".format(nonterm.name)
+    def emitfunc(self, nonterm, name=None, recognize=False, events=False):
+        # Source of the parse function for nonterm. With recognize, it only
+        # checks the input, building and returning nothing; with events, it
+        # is a generator of parse events instead (see emitevents).
+        s = self.head(name or fname(nonterm.name), nonterm.name, trace=not (recognize or events))
+        recognize = recognize or events
         epsilon = False
         alltoks = set()
         # if isinstance(nonterm, Operator):
@@ -505,85 +968,695 @@ class Emitter(object):
         #     return
         if len(nonterm.rules) == 0:
             raise Exception("No definition for nonterminal {}".format(nonterm))
-        for rule in nonterm.rules:
+        if self.loops and self.islist(nonterm):
+            return self.emitloop(s, nonterm, recognize, events)
+        peek = self.peek(self.expected(nonterm))
+        branches = []  # (first set, source, index) of each production taken on a token
+        empty = None  # (index, source) of the empty production
+        for index, rule in enumerate(nonterm.rules):
             epsilon |= None in rule[0]
             firsts = rule[0].difference(set((None,)))
-            tokset = "(\"{}\",)".format('\", \"'.join([tok.name for tok in firsts]))
             alltoks.update(firsts)  # get all tokens together for error case
             production = rule[1]
             variables = []
             if not production.prod[0]:
+                empty = (index, "        return  # epsilon case\n")
+                if not recognize:
+                    empty = (index, self.hit(nonterm, index, "        ") + empty[1])
                 continue
             if isinstance(nonterm, Set):
-                return self.emitset(s, nonterm)
-            else:
-                s += "        if self.next() in {}:\n".format(tokset)
-                
+                return self.emitset(s, nonterm, name or fname(nonterm.name), recognize, events)
+            b = ''
+            if not (recognize or isinstance(nonterm, Repeat)):
+                b += self.hit(nonterm, index, "            ")
+            if events and not isinstance(nonterm, Operator):
+                b += "            yield ENTER, \"{}\", {}\n".format(nonterm.name, self.eventbinding(production))
+
             if isinstance(nonterm, Repeat):
                 if len(production.prod) > 1:
                     raise Exception("Repeat operator can only be applied to a single terminal or nonterminal")
                 term = production.prod[0]
                 cleanname = sanitize(term.name)
-                variables.append("var{}_{}".format(0, cleanname))
-                s += "            var0_{} = []\n".format(cleanname)
-                s += "            while self.next() in {}:\n".format(tokset)
-                if isinstance(term, Nonterminal):
-                    s += "                var0_{}.append(self.{}())\n".format(cleanname, fname(cleanname))
+                variables.append("self.makelist(var{}_{})".format(0, cleanname))
+                if not recognize:
+                    b += "            var0_{} = []\n".format(cleanname)
+                b += "            while {} {}:\n".format(peek, self.lookahead(firsts))
+                if recognize:
+                    b += "                {}\n".format(self.call(term, events))
+                elif isinstance(term, Nonterminal):
+                    b += "                var0_{}.append(self.{}())\n".format(cleanname, fname(cleanname))
                 else:
-                    s += "                var0_{}.append(self.consume(\"{}\"))\n".format(cleanname, term.name)
+                    b += "                var0_{}.append(self.consume({}))\n".format(cleanname, self.kind(term))
                 epsilon = True  # repeats can be taken 0 times; equivalent to an episilon production
             else:
-                for i,term in enumerate(production.prod):
-                    cleanname = sanitize(term.name)
-                    variables.append("var{}_{}".format(i, cleanname))
-                    if isinstance(term, Nonterminal):
-                        s += "            var{}_{} = self.{}()\n".format(i, cleanname, fname(cleanname))
-                    else:
-                        s += "            var{}_{} = self.consume(\"{}\")\n".format(i, cleanname, term.name)
+                body, variables = self.parseterms(production.prod, "            ", recognize, events)
+                b += body
 
             # print(production, dir(production))
-            if production.pclass:
-                binding = production.pclass
-                if binding[0] == "_":  # suppress this production
-                    s += "            return  # production suppressed\n"
-                    continue
-                attrs = zip(binding[1:], variables)
-                sargs = ''
-                for name, variable in attrs:
-                    sargs += "('{}', {}),".format(name, variable)
-                s += "            return {}({})\n".format(production.pclass[0], sargs)
+            if events and not isinstance(nonterm, Operator):
+                b += "            yield EXIT, \"{}\"\n".format(nonterm.name)
+            if recognize:
+                b += "            return\n"
+            elif production.pclass and production.pclass[0] == "_":  # suppress this production
+                b += "            return  # production suppressed\n"
+            elif production.pclass:
+                b += "            return {}\n".format(self.construct(production.pclass, variables))
             else:
-                s += "            return {}\n".format(', '.join(variables))
-        if epsilon:
+                b += "            return {}\n".format(', '.join(variables))
+            branches.append((firsts, b, index))
+        pre, s = self.branch(s, name or fname(nonterm.name), peek, branches, events, nonterm, empty)
+        if empty:
+            s += empty[1] + "\n"
+        elif epsilon:
             s += "        return  # epsilon case\n\n"
         else:  # error case
             # if isinstance(nonterm, Optional):
             #     s += "        return  # this production declared as optional\n\n"
             # else:
-            alltokset = "(\"{}\",)".format('\", \"'.join([tok.name for tok in alltoks]))
-            s += "        self.parsefail({}, self.next())\n\n".format(alltokset)
+            s += "        self.parsefail({}, self.next())\n\n".format(self.tokset(alltoks))
+
+        return pre + s
+
+    def branch(self, s, name, peek, branches, events=False, nonterm=None, empty=None):
+        # Add to the parse function s the choice between branches, the
+        # (first set, source, index) of each production taken on a token.
+        # Up to DISPATCH of them are tested in turn; a rule with more has
+        # each in its own function, name_altN, and looks up which to call
+        # in a dict from token kind to function, name_alts, so a choice
+        # costs one lookahead and one lookup however many there are.
+        # Returns the source to put before the parse function, and s.
+        if self.optimize:
+            # alias consume in productions that call it more than once
+            branches = [(firsts, "            consume = self.consume\n" + b.replace("self.consume(", "consume(")
+                         if b.count("self.consume(") > 1 else b, i) for firsts, b, i in branches]
+        if len(branches) < DISPATCH:
+            return self.chain(s, name, peek, branches, events, nonterm, empty)
+        pre = ''
+        alts = {}
+        for i, (firsts, b, index) in enumerate(branches):
+            pre += "    def {}_alt{}(self):\n".format(name, i)
+            pre += ''.join(line[4:] + '\n' for line in b.splitlines()) + '\n'
+            for kind in sorted(self.kinds[t.name] for t in firsts):
+                alts.setdefault(kind, i)  # the first production to have it, as when tested in turn
+        pre += "    {}_alts = {{\n".format(name)
+        for kind, i in sorted(alts.items()):
+            pre += "        {}: {}_alt{},\n".format(self.kindconsts[kind], name, i)
+        pre += "    }\n\n"
+        s += "        alt = self.{}_alts.get({})\n".format(name, peek)
+        s += "        if alt is not None:\n"
+        if events:
+            s += "            yield from alt(self)\n"
+            s += "            return\n"
+        else:
+            s += "            return alt(self)\n"
+        return pre, s
+
+    def chain(self, s, name, peek, branches, events=False, nonterm=None, empty=None):
+        # branch for fewer than DISPATCH productions, tested in turn. With
+        # --profile-data, they are tested in the order hottest gives, and
+        # those the profile never saw taken are moved into functions of
+        # their own, name_coldN, to keep the parse function short. If the
+        # rule's empty production, empty, was taken more often than any
+        # other, it is tested for first, with one test.
+        pre = ''
+        counts = self.counts(nonterm)
+        fast = False
+        if counts:
+            branches = self.hottest(branches, counts)
+            fast = empty and len(branches) > 1 and counts[empty[0]] > max(counts[i] for f, b, i in branches)
+        if self.optimize and len(branches) > 1:
+            s += "        tok = {}\n".format(peek)
+            peek = "tok"
+        if fast:
+            alltoks = set().union(*(firsts for firsts, b, i in branches))
+            s += "        if {} {}:\n".format(peek, self.lookahead(alltoks, True))
+            s += ''.join("    " + line + "\n" for line in empty[1].splitlines())
+        for firsts, b, i in branches:
+            s += "        if {} {}:\n".format(peek, self.lookahead(firsts))
+            if counts and not counts[i]:
+                pre += "    def {}_cold{}(self):\n".format(name, i)
+                pre += ''.join(line[4:] + '\n' for line in b.splitlines()) + '\n'
+                if events:
+                    s += "            yield from self.{}_cold{}()\n".format(name, i)
+                    s += "            return\n"
+                else:
+                    s += "            return self.{}_cold{}()\n".format(name, i)
+            else:
+                s += b
+        return pre, s
+
+    def hottest(self, branches, counts):
+        # branches, each ending with its production's index in counts, with
+        # the ones taken most often first; but a production is never put
+        # ahead of one written before it with first tokens in common, as
+        # that one is taken on them
+        branches = list(branches)
+        ordered = []
+        while branches:
+            free = [x for i, x in enumerate(branches) if not any(x[0] & y[0] for y in branches[:i])]
+            best = max(free, key=lambda x: counts[x[-1]])  # the first of equals, as written
+            ordered.append(best)
+            branches.remove(best)
+        return ordered
+
+    def counts(self, nonterm):
+        # How often the --profile-data profile has each of nonterm's
+        # productions (a Set's choices) taken, or None if it has none
+        if nonterm is None or nonterm.name not in self.profile:
+            return None
+        counts = self.profile[nonterm.name]
+        size = len(nonterm.args) if isinstance(nonterm, Set) else len(nonterm.rules)
+        if len(counts) != size:
+            raise Exception("Profile has {} productions for {}, but the grammar has {}; profile it again".format(len(counts), nonterm, size))
+        return counts if any(counts) else None
+
+    def hit(self, nonterm, index, indent):
+        # With --profile, the source counting in PROFILE that nonterm's
+        # production (a Set's choice) index was taken
+        if not self.instrument:
+            return ''
+        self.profiled[nonterm.name] = len(nonterm.args) if isinstance(nonterm, Set) else len(nonterm.rules)
+        return "{}PROFILE[\"{}\"][{}] += 1\n".format(indent, nonterm.name, index)
+
+    def head(self, name, rule, params=None, trace=True):
+        # The def line of a parse function for rule, params being its extra
+        # (parameter, argument) if any, and the logging of it. With -O,
+        # that is left to TracedParser, which overrides the ones traced.
+        s = ''
+        s += "    def {}(self{}):\n".format(name, ", " + params[0] if params else "")
+        if not self.optimize:
+            s += "        if self.log:\n"
+            s += "            print(\"{}\")\n".format(rule)
+        elif trace:
+            self.traced.append((name, rule, params))
+        return s
+
+    def emittraced(self):
+        # -O's TracedParser, what Parser(log=True) makes: each parse function
+        # logs its rule and calls Parser's, which has no checks of self.log
+        s = ''
+        s += "\nclass TracedParser(Parser):\n"
+        s += "    # Parser with logging, for -O\n\n"
+        for name, rule, params in self.traced:
+            s += "    def {}(self{}):\n".format(name, ", " + params[0] if params else "")
+            s += "        print(\"{}\")\n".format(rule)
+            s += "        return Parser.{}(self{})\n\n".format(name, ", " + params[1] if params else "")
+        if self.contextual:
+            return s  # its consume() still logs
+        s += "    def consume(self, tok):\n"
+        s += "        if self.tok is not None:\n"
+        s += "            print(\"consuming {}:{}\".format(tokname(tok), self.match))\n"
+        s += "        return Parser.consume(self, tok)\n\n"
+        return s
+
+    def parseterms(self, terms, indent, recognize=False, events=False, prefix="var", checked=True):
+        # Source parsing terms in turn, each line starting with indent, and
+        # the variables their values are put in. An inlined rule (see
+        # findinlines) is parsed by its productions spliced in rather than
+        # a call, its variables named after the one its value goes in.
+        # checked is whether the lookahead is known to start the first term.
+        s = ''
+        variables = []
+        for i, term in enumerate(terms):
+            variables.append("{}{}_{}".format(prefix, i, sanitize(term.name)))
+            if term in self.inlined:
+                s += self.inlineterm(term, variables[-1], indent, recognize, events, checked and i == 0)
+            elif recognize:
+                s += "{}{}\n".format(indent, self.call(term, events))
+            elif isinstance(term, Nonterminal):
+                s += "{}{} = self.{}()\n".format(indent, variables[-1], fname(sanitize(term.name)))
+            else:
+                s += "{}{} = self.consume({})\n".format(indent, variables[-1], self.kind(term))
+        return s, variables
+
+    def inlineterm(self, nonterm, var, indent, recognize, events, checked):
+        # Source doing what nonterm's parse function would, in place of the
+        # call to it (see parseterms): the same choice between productions,
+        # trace and events, and the same error if none can be taken, with
+        # the value put in var. A single production that can't be empty
+        # needs no choice, nor, if the caller has checked it, any test.
+        # With --profile-data, productions are tested as in chain.
+        s = ''
+        if not (recognize or self.optimize):
+            s += "{}if self.log:\n".format(indent)
+            s += "{}    print(\"{}\")\n".format(indent, nonterm.name)
+        peek = self.peek(self.expected(nonterm))
+        alltoks = set()
+        epsilon = False
+        branches = []
+        empty = None
+        for index, (first, production) in enumerate(nonterm.rules):
+            epsilon |= None in first
+            firsts = first.difference(set((None,)))
+            alltoks.update(firsts)
+            if production.prod[0]:
+                branches.append((firsts, production, index))
+            else:
+                empty = index
+        counts = self.counts(nonterm)
+        fast = False
+        if counts:
+            branches = self.hottest(branches, counts)
+            fast = empty is not None and len(branches) > 1 and counts[empty] > max(counts[i] for f, p, i in branches)
+        flat = len(branches) == 1 and not epsilon
+        if fast:
+            s += "{}if {} {}:\n".format(indent, peek, self.lookahead(alltoks, True))
+            if not recognize:
+                s += self.hit(nonterm, empty, indent + "    ")
+                s += "{}    {} = None  # epsilon case\n".format(indent, var)
+            else:
+                s += "{}    pass  # epsilon case\n".format(indent)
+        if flat and not checked:
+            s += "{}if {} {}:\n".format(indent, peek, self.lookahead(alltoks, True))
+            s += "{}    self.parsefail({}, self.next())\n".format(indent, self.tokset(alltoks))
+        for i, (firsts, production, index) in enumerate(branches):
+            inner = indent
+            if not flat:
+                s += "{}{} {} {}:\n".format(indent, "elif" if i or fast else "if", peek, self.lookahead(firsts))
+                inner += "    "
+            if not recognize:
+                s += self.hit(nonterm, index, inner)
+            if events:
+                s += "{}yield ENTER, \"{}\", {}\n".format(inner, nonterm.name, self.eventbinding(production))
+            body, variables = self.parseterms(production.prod, inner, recognize, events, var + "_")
+            s += body
+            if events:
+                s += "{}yield EXIT, \"{}\"\n".format(inner, nonterm.name)
+            if recognize:
+                pass
+            elif production.pclass and production.pclass[0] == "_":  # suppress this production
+                s += "{}{} = None\n".format(inner, var)
+            elif production.pclass:
+                s += "{}{} = {}\n".format(inner, var, self.construct(production.pclass, variables))
+            else:
+                s += "{}{} = {}\n".format(inner, var, ', '.join(variables))
+        if flat or fast:
+            pass
+        elif not epsilon:
+            s += "{}else:\n".format(indent)
+            s += "{}    self.parsefail({}, self.next())\n".format(indent, self.tokset(alltoks))
+        elif not recognize:
+            s += "{}else:\n".format(indent)
+            if empty is not None:
+                s += self.hit(nonterm, empty, indent + "    ")
+            s += "{}    {} = None  # epsilon case\n".format(indent, var)
+        return s
+
+    def findinlines(self):
+        # The rules for --inline to splice into the productions using them.
+        # They are plain choices between fewer than DISPATCH productions;
+        # rules used once are taken first, then, from the shortest, rules
+        # used more than once that are at most INLINE terms long with the
+        # rules taken so far spliced in. A rule is passed over if it would
+        # end up spliced into itself, or make a rule taken before it longer
+        # than INLINE.
+        uses = dict((nt, 0) for nt in self.nonterminals)
+        for nt in self.nonterminals:
+            for first, production in nt.rules:
+                for term in production.prod:
+                    if term in uses:
+                        uses[term] += 1
+        candidates = [nt for nt in self.nonterminals if not isinstance(nt, Operator)
+                      and nt.name not in self.binops and not (self.loops and self.islist(nt))
+                      and len([p for f, p in nt.rules if p.prod[0]]) < DISPATCH]
+
+        inlined = set()
+        def terms(nt):
+            return [term for first, production in nt.rules for term in production.prod if term]
+        def size(nt):
+            return sum(size(term) if term in inlined else 1 for term in terms(nt))
+        def cyclic(nt):
+            # whether nt can be reached from itself through inlined rules
+            stack = [x for x in terms(nt) if x in inlined or x == nt]
+            seen = set()
+            while stack:
+                term = stack.pop()
+                if term == nt:
+                    return True
+                if term not in seen:
+                    seen.add(term)
+                    stack.extend(x for x in terms(term) if x in inlined or x == nt)
+            return False
+
+        for nt in candidates:
+            if uses[nt] <= 1 and not cyclic(nt):
+                inlined.add(nt)
+        shared = []
+        for nt in sorted((nt for nt in candidates if uses[nt] > 1), key=size):
+            if size(nt) > INLINE or cyclic(nt):
+                continue
+            inlined.add(nt)
+            if any(size(x) > INLINE for x in shared):
+                inlined.remove(nt)
+            else:
+                shared.append(nt)
+        return inlined
+
+    def chains(self):
+        # How many parse functions are being called when each token is
+        # consumed, at the least: [(token name, calls)] in the order the
+        # tokens are declared. Inlined rules cost none; a rule dispatching
+        # on a dict (see branch) costs one more, for its _altN function, as
+        # do the productions moved into _coldN functions (see chain).
+        calls = {self.namemap[self.start]: 1}
+        tokens = {}
+        queue = deque([self.namemap[self.start]])
+        while queue:
+            nt = queue.popleft()
+            if nt.name in self.binops:
+                # operators are consumed by the precedence climbing loop,
+                # the other productions by parseN_operand
+                for op, binding in self.binops[nt.name]:
+                    for term in self.optokens(op, nt):
+                        tokens[term.name] = min(calls[nt], tokens.get(term.name, calls[nt]))
+            cost = calls[nt] + (1 if nt.name in self.binops else 0)
+            if isinstance(nt, Set):
+                choices = [(term,) for first, production in nt.rules for term in production.prod]
+            else:
+                choices = [production.prod for first, production in nt.rules]
+            counts = self.counts(nt)
+            if len([x for x in choices if x[0]]) >= DISPATCH:
+                cost += 1
+                counts = None
+            elif self.loops and self.islist(nt):
+                counts = None
+            # (term, calls when it is parsed) of each term, going into
+            # inlined rules
+            terms = deque((term, cost + (1 if counts and not counts[i] else 0))
+                          for i, prod in enumerate(choices) for term in prod if term)
+            while terms:
+                term, depth = terms.popleft()
+                if isinstance(term, Terminal):
+                    if depth < tokens.get(term.name, depth + 1):
+                        tokens[term.name] = depth
+                elif term in self.inlined and not isinstance(nt, (Repeat, Set)):
+                    terms.extend((x, depth) for first, production in term.rules for x in production.prod if x)
+                elif depth + 1 < calls.get(term, depth + 2):
+                    calls[term] = depth + 1
+                    queue.append(term)
+        return [(name, tokens[name]) for name, regex in self.lexmap if name in tokens]
+
+    def call(self, term, events=False):
+        # Source parsing term: a call to its parse function, or consuming it
+        if events and isinstance(term, Nonterminal):
+            return "yield from self.{}()".format(fname(sanitize(term.name)))
+        elif events:
+            return "yield self.tokenevent({})".format(self.kind(term))
+        elif isinstance(term, Nonterminal):
+            return "self.{}()".format(fname(sanitize(term.name)))
+        return "self.consume({})".format(self.kind(term))
+
+    def eventbinding(self, production):
+        # The binding reported when production is entered: its name, or
+        # None if it has none or is suppressed
+        if production.pclass and production.pclass[0] != "_":
+            return "\"{}\"".format(production.pclass[0])
+        return None
+
+    def emitrecognizer(self):
+        # A Parser subclass whose parse functions only check the input, and
+        # validate(s) using it
+        s = ''
+        s += "\nclass Recognizer(Parser):\n"
+        s += "    # Checks input against the grammar without building an AST\n\n"
+        if self.table:
+            s += TABLERECOGNIZER
+        else:
+            s += ''.join(self.emitpratt(nt, True) if nt.name in self.binops else self.emitfunc(nt, recognize=True)
+                         for nt in self.nonterminals)
+        return s + VALIDATE
+
+    def emitevents(self):
+        # A Parser subclass whose parse functions are generators of parse
+        # events, and iterparse(s) using it. Only named rules are reported;
+        # anonymous operators and empty productions give just the events of
+        # what they contain. Precedence climbing folds operators in after
+        # their left operand is parsed, so an event stream can't announce
+        # them in order, and iterparse isn't emitted for such grammars.
+        if self.binops:
+            return ''
+        s = ''
+        s += "\nclass EventParser(Parser):\n"
+        s += "    # Reports the parse as a stream of events without building an AST\n"
+        s += EVENTPARSER
+        if self.table:
+            s += TABLEEVENTS
+        else:
+            s += ''.join(self.emitfunc(nt, events=True) for nt in self.nonterminals)
+        return s + ITERPARSE
+
+    def optokens(self, op, nonterm):
+        # The tokens an operator in N := N op N stands for: a token, or a
+        # set of them ({ plus minus }), each with a declared precedence
+        if op in self.tokenmap:
+            terms = [self.tokenmap[op]]
+        elif isinstance(self.namemap.get(op), Set):
+            terms = [self.tokenmap.get(x) for x in self.namemap[op].args]
+        else:
+            terms = [None]
+        if None in terms:
+            raise Exception("Operator in {} := {} {} {} must be a token or a set of tokens".format(nonterm, nonterm, op, nonterm))
+        for term in terms:
+            if term.name not in self.precedence:
+                raise Exception("No %left, %right or %nonassoc precedence declared for operator {} in {}".format(term.name, nonterm))
+        return terms
+
+    def emitpratt(self, nonterm, recognize=False):
+        # Parse the N := N op N productions of nonterm by precedence climbing.
+        # Operands are parsed by N's other productions (parseN_operand), and
+        # one loop folds in each operator binding at least as tightly as
+        # minprec, so an expression costs one call per operand rather than
+        # one per precedence level.
+        table = "PREC_{}".format(sanitize(nonterm.name))
+        if recognize:
+            return self.emitprattrecognizer(nonterm, table)
+        self.consts.append("# token kind -> (precedence, right operand's minprec, nonassoc, build)\n")
+        self.consts.append("{} = {{\n".format(table))
+        for op, binding in self.binops[nonterm.name]:
+            if binding and binding[0] == "_":
+                build = "lambda p, l, o, r: None"
+            elif binding:
+                build = "lambda p, l, o, r: {}".format(self.construct(binding, ('l', 'o', 'r'), "p"))
+            else:
+                build = "lambda p, l, o, r: (l, o, r)"
+            for term in self.optokens(op, nonterm):
+                level, assoc = self.precedence[term.name]
+                rightprec = level if assoc == "%right" else level + 1
+                self.consts.append("    {}: ({}, {}, {}, {}),  # {} {}\n".format(
+                    self.kind(term), level, rightprec, assoc == "%nonassoc", build, assoc, term.name))
+        self.consts.append("}\n")
+
+        s = self.head(fname(nonterm.name), nonterm.name, ("minprec=0", "minprec"))
+        s += "        left = self.{}_operand()\n".format(fname(nonterm.name))
+        s += "        while True:\n"
+        s += "            op = {}.get({})\n".format(table, self.peek(self.follow.get(nonterm)))
+        s += "            if op is None or op[0] < minprec:\n"
+        s += "                return left\n"
+        s += "            prec, rightprec, nonassoc, build = op\n"
+        s += "            var = self.consume(self.next())\n"
+        s += "            left = build(self, left, var, self.{}(rightprec))\n".format(fname(nonterm.name))
+        s += "            if nonassoc and {}.get({}, (None,))[0] == prec:\n".format(table, self.peek(self.follow.get(nonterm)))
+        s += "                raise Parser.ParseError(\"Parse Error, {}: Operator {} is non-associative\".format(self.location(), tokname(self.next())))\n"
+        s += "\n"
+        return s + self.emitfunc(nonterm, fname(nonterm.name) + "_operand")
+
+    def emitprattrecognizer(self, nonterm, table):
+        # emitpratt for the Recognizer
+        s = self.head(fname(nonterm.name), nonterm.name, ("minprec=0", "minprec"), False)
+        s += "        self.{}_operand()\n".format(fname(nonterm.name))
+        s += "        while True:\n"
+        s += "            op = {}.get({})\n".format(table, self.peek(self.follow.get(nonterm)))
+        s += "            if op is None or op[0] < minprec:\n"
+        s += "                return\n"
+        s += "            self.consume(self.next())\n"
+        s += "            self.{}(op[1])\n".format(fname(nonterm.name))
+        s += "            if op[2] and {}.get({}, (None,))[0] == op[0]:\n".format(table, self.peek(self.follow.get(nonterm)))
+        s += "                raise Parser.ParseError(\"Parse Error, {}: Operator {} is non-associative\".format(self.location(), tokname(self.next())))\n"
+        s += "\n"
+        return s + self.emitfunc(nonterm, fname(nonterm.name) + "_operand", True)
+
+    def islist(self, nonterm):
+        # True for a rule like Decls := Decl Decls | $, where every production
+        # is epsilon or ends by recursing into the rule itself
+        if isinstance(nonterm, Operator):
+            return False
+        tail = epsilon = False
+        for first, production in nonterm.rules:
+            if not production.prod[0]:
+                epsilon = True
+            elif len(production.prod) < 2 or production.prod[-1] != nonterm:
+                return False
+            elif production.pclass and production.pclass[0] == "_":
+                return False
+            else:
+                tail = True
+        return tail and epsilon
+
+    def emitloop(self, s, nonterm, recognize=False, events=False):
+        # Parse a list rule (see islist) with a while loop instead of one
+        # recursive call per item. Each item is built as if the production
+        # stopped before its recursive call, and the items are returned as
+        # a flat list, or None if there are none, as for the Repeat operator.
+        s += "        items = []\n"
+        s += "        while True:\n"
+        for first, production in nonterm.rules:
+            if not production.prod[0]:
+                continue
+            s += "            if {} {}:\n".format(self.peek(self.expected(nonterm)), self.lookahead(first))
+            if events:
+                s += "                yield ENTER, \"{}\", {}\n".format(nonterm.name, self.eventbinding(production))
+            body, variables = self.parseterms(production.prod[:-1], "                ", recognize, events)
+            s += body
+            if events:
+                s += "                yield EXIT, \"{}\"\n".format(nonterm.name)
+            if recognize:
+                pass
+            elif production.pclass:
+                s += "                items.append({})\n".format(self.construct(production.pclass, variables))
+            elif len(variables) == 1:
+                s += "                items.append({})\n".format(variables[0])
+            else:
+                s += "                items.append(({}))\n".format(', '.join(variables))
+            s += "                continue\n"
+        if recognize:
+            s += "            return\n\n"
+        else:
+            s += "            return self.makelist(items) if items else None\n\n"
+        return s
+
+    def emittable(self):
+        # Emit the grammar as an LL(1) parse table instead of one function
+        # per nonterminal. Symbols in a production are token kinds, or ~i
+        # for the i-th nonterminal; the driver in stock.TABLEDRIVER walks
+        # them with an explicit stack. Each production carries a function
+        # building the same value the recursive-descent parser returns.
+        if self.binops:
+            raise Exception("%left, %right and %nonassoc are only supported by recursive-descent parsers")
+        ids = dict((nt, i) for i, nt in enumerate(self.nonterminals))
+        prods = ["    ((), lambda p, v: None, None),  # epsilon\n"]
+        events = ["    (None, None),\n"]
+        rows = []
+
+        def symbol(term):
+            if isinstance(term, Nonterminal):
+                return "~{}".format(ids[term])
+            return self.kind(term)
 
-        self.parser += s
+        def addprod(symbols, build, loop, comment, event=(None, None)):
+            prods.append("    (({},), {}, {}),  # {}\n".format(
+                ', '.join(symbols), build, loop, comment))
+            events.append("    ({}, {}),\n".format(*event))
+            return len(prods) - 1
 
-    def emitset(self, s, nonterm):
+        for nt in self.nonterminals:
+            if len(nt.rules) == 0:
+                raise Exception("No definition for nonterminal {}".format(nt))
+            table = {}
+            default = None
+            alltoks = set()
+            if isinstance(nt, Set):
+                # one production per choice, tried in the order written
+                for term in nt.args:
+                    term = self.tokenmap.get(term) or self.namemap[term]
+                    firsts = set(x for x in term.first if x)
+                    alltoks.update(firsts)
+                    i = addprod((symbol(term),), "lambda p, v: v[0]", None, "{} => {}".format(nt, term))
+                    for t in firsts:
+                        table.setdefault(self.kinds[t.name], i)
+            for rule in ([] if isinstance(nt, Set) else nt.rules):
+                firsts = rule[0].difference(set((None,)))
+                alltoks.update(firsts)
+                if None in rule[0]:
+                    default = 0
+                prod = rule[1]
+                if not prod.prod[0]:
+                    continue
+                symbols = [symbol(term) for term in prod.prod]
+                loop = None
+                if isinstance(nt, Repeat):
+                    if len(prod.prod) > 1:
+                        raise Exception("Repeat operator can only be applied to a single terminal or nonterminal")
+                    build = "lambda p, v: p.makelist(v)"
+                    loop = self.tokset(firsts)
+                    default = 0
+                elif prod.pclass and prod.pclass[0] == "_":
+                    build = "lambda p, v: None"
+                elif prod.pclass:
+                    variables = ["v[{}]".format(i) for i in range(len(symbols))]
+                    build = "lambda p, v: {}".format(self.construct(prod.pclass, variables, "p"))
+                elif len(symbols) == 1:
+                    build = "lambda p, v: v[0]"
+                else:
+                    build = "lambda p, v: tuple(v)"
+                event = (None, None)
+                if not isinstance(nt, Operator):
+                    event = ("\"{}\"".format(nt.name), self.eventbinding(prod))
+                i = addprod(symbols, build, loop, prod, event)
+                for t in firsts:
+                    table.setdefault(self.kinds[t.name], i)
+            entries = ', '.join("{}: {}".format(self.kindconsts[k], v) for k, v in sorted(table.items()))
+            expected = self.tokset(alltoks) if alltoks else "frozenset()"
+            rows.append("    ({{{}}}, {}, {}),  # {}\n".format(entries, default, expected, nt))
+
+        s = ''
+        s += "NONTERMINALS = {}\n\n".format([nt.name for nt in self.nonterminals])
+        s += "# (symbols, build, loop): a symbol is a token kind or ~nonterminal;\n"
+        s += "# build(parser, values) makes the value from the symbols' values;\n"
+        s += "# if the lookahead is in loop once the symbols are parsed, they are\n"
+        s += "# parsed again\n"
+        s += "PRODUCTIONS = [\n" + ''.join(prods) + "]\n\n"
+        s += "# ({lookahead: production}, production otherwise, expected tokens)\n"
+        s += "PARSETABLE = [\n" + ''.join(rows) + "]\n\n"
+        s += "# (rule, binding) each production reports to the EventParser\n"
+        s += "EVENTS = [\n" + ''.join(events) + "]\n\n"
+        self.parser += TABLEDRIVER
+        return s
+
+    def emitset(self, s, nonterm, name, recognize=False, events=False):
         alltoks = set()
-        for term in nonterm.args:
+        peek = self.peek(self.expected(nonterm))
+        branches = []
+        for index, term in enumerate(nonterm.args):
             if term in self.tokenmap:
                 term = self.tokenmap[term]
             else:
                 term = self.namemap[term]
             firsts = term.first
-            tokset = "(\"{}\",)".format('\", \"'.join([tok.name for tok in firsts]))
             alltoks.update(firsts)
-            s += "        if self.next() in {}:\n".format(tokset)
-            if isinstance(term, Nonterminal):
-                s += "            return self.{}()\n".format(fname(sanitize(term.name)))
+            if recognize:
+                b = "            {}\n".format(self.call(term, events))
+                b += "            return\n"
+            elif isinstance(term, Nonterminal):
+                b = self.hit(nonterm, index, "            ")
+                b += "            return self.{}()\n".format(fname(sanitize(term.name)))
             else:
-                s += "            return self.consume(\"{}\")\n".format(term.name)
-        alltokset = "(\"{}\",)".format('\", \"'.join([tok.name for tok in alltoks]))
-        s += "        self.parsefail({}, self.next())\n\n".format(alltokset)
-        self.parser += s
-        return
+                b = self.hit(nonterm, index, "            ")
+                b += "            return self.consume({})\n".format(self.kind(term))
+            branches.append((firsts, b, index))
+        pre, s = self.branch(s, name, peek, branches, events, nonterm)
+        s += "        self.parsefail({}, self.next())\n\n".format(self.tokset(alltoks))
+        return pre + s
+
+def literal(regex):
+    # The text regex matches, if it is a plain string; else None
+    text = ''
+    i = 0
+    while i < len(regex):
+        if regex[i] == '\\':
+            if i + 1 == len(regex) or regex[i+1].isalnum():
+                return None
+            i += 1
+        elif regex[i] in '.^$*+?{}[]|()':
+            return None
+        text += regex[i]
+        i += 1
+    return text
+
+def bindpairs(names, values):
+    # The (field, value) pairs a binding's names give values: '_' is
+    # dropped, and a field named more than once gets the last of its values
+    pairs = [(x, v) for x, v in zip(names, values) if x != "_"]
+    return [(x, v) for k, (x, v) in enumerate(pairs) if x not in [y for y, w in pairs[k+1:]]]
 
 def sanitize(name):
     return re.sub('[^0-9a-zA-Z_]', '', name)
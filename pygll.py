@@ -1,5 +1,7 @@
-from stock import PCLASS, MAIN
-import re, sys
+from stock import PCLASS, MAIN, PROFILEMAIN
+import json
+import re, sys, argparse
+from collections import deque
 from emitter import Emitter
 
 class GrammarObj(object):
@@ -91,7 +93,17 @@ class Names(GrammarObj):
         super().__init__(*args)
         self.name = "Names"
 
-LEXMAP = [('pound', '#'), ('bar', '\|'), ('epsilon', '\$'), ('lrepeat', '\['), ('rrepeat', '\]'), ('lset', '{'), ('rset', '}'), ('lopt', '<'), ('ropt', '>'), ('string', '(\\\'|\\").*?[^\\\\]\\1'), ('name', '\w+'), ('%root', '%root'), ('%tokens', '%tokens'), ('%grammar', '%grammar'), (':=', ':='), (';', ';')]
+class Precedences(GrammarObj):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.name = "Precedences"
+
+class Precedence(GrammarObj):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.name = "Precedence"
+
+LEXMAP = [('pound', '#'), ('bar', '\|'), ('epsilon', '\$'), ('lrepeat', '\['), ('rrepeat', '\]'), ('lset', '{'), ('rset', '}'), ('lopt', '<'), ('ropt', '>'), ('string', '(\\\'|\\").*?[^\\\\]\\1'), ('name', '\w+'), ('%root', '%root'), ('%tokens', '%tokens'), ('%ignore', '%ignore'), ('%left', '%left'), ('%right', '%right'), ('%nonassoc', '%nonassoc'), ('%grammar', '%grammar'), (':=', ':='), (';', ';')]
 
 
 class Parser(object):
@@ -115,6 +127,7 @@ class Parser(object):
 
     def parse(self, s):
         self.toks, self.remaining = self.scanner.scan(s)
+        self.toks = deque(self.toks)
         self.trim()
         return self._parseRoot()
 
@@ -126,7 +139,7 @@ class Parser(object):
             token, match = self.toks[0]
             if token == "whitespace":
                 self.line += match.count('\n')
-                self.toks.pop(0)
+                self.toks.popleft()
                 self.trim()
 
     def next(self):
@@ -141,7 +154,7 @@ class Parser(object):
             self.scanfail()
         if len(self.toks) == 0:
             self.parsefail(tok, 'EOF')
-        token,match = self.toks.pop(0)
+        token,match = self.toks.popleft()
         if self.log:
             print("consuming {}:{}".format(tok, match))
         if tok != token:
@@ -156,8 +169,9 @@ class Parser(object):
         if self.next() in ("%root",):
             var0_RootDecl = self.parseRootDecl()
             var1_TokenDecl = self.parseTokenDecl()
-            var2_GrammarDecl = self.parseGrammarDecl()
-            return var0_RootDecl, var1_TokenDecl, var2_GrammarDecl
+            var2_PrecDecls = self.parsePrecDecls()
+            var3_GrammarDecl = self.parseGrammarDecl()
+            return var0_RootDecl, var1_TokenDecl, var2_PrecDecls, var3_GrammarDecl
         self.parsefail(['("%root",)'], self.next())
 
     def parseRootDecl(self):
@@ -171,9 +185,47 @@ class Parser(object):
         if self.next() in ("%tokens",):
             var0_tokens = self.consume("%tokens")
             var1_TokenPairs = self.parseTokenPairs()
-            return var0_tokens, var1_TokenPairs
+            var2_IgnoreDecl = self.parseIgnoreDecl()
+            return var0_tokens, var1_TokenPairs, var2_IgnoreDecl
         self.parsefail(['("%tokens",)'], self.next())
 
+    def parseIgnoreDecl(self):
+        if self.next() in ("%ignore",):
+            var0_ignore = self.consume("%ignore")
+            var1_TokenPairs = self.parseTokenPairs()
+            return var0_ignore, var1_TokenPairs
+        return  # epsilon case
+
+    # The lists below are parsed with loops rather than one call per item,
+    # so that grammars can have any number of rules, productions and
+    # terms, and linked up from the end as the recursive rules would
+
+    def parsePrecDecls(self):
+        items = []
+        while self.next() in ("%left", "%right", "%nonassoc",):
+            items.append(self.parsePrecDecl())
+        rest = None
+        for var0_PrecDecl in reversed(items):
+            rest = Precedences(('decl', var0_PrecDecl),('rest', rest),)
+        return rest
+
+    def parsePrecDecl(self):
+        if self.next() in ("%left", "%right", "%nonassoc",):
+            var0__anon_Set0 = self.parse_anon_Set0()
+            var1_name = self.consume("name")
+            var2_Names = self.parseNames()
+            return Precedence(('assoc', var0__anon_Set0),('pname', var1_name),('names', var2_Names),)
+        self.parsefail(['("%left", "%right", "%nonassoc",)'], self.next())
+
+    def parse_anon_Set0(self):
+        if self.next() in ("%left",):
+            return self.consume("%left")
+        if self.next() in ("%right",):
+            return self.consume("%right")
+        if self.next() in ("%nonassoc",):
+            return self.consume("%nonassoc")
+        self.parsefail(("%left", "%right", "%nonassoc",), self.next())
+
     def parseGrammarDecl(self):
         if self.next() in ("%grammar",):
             var0_grammar = self.consume("%grammar")
@@ -182,19 +234,24 @@ class Parser(object):
         self.parsefail(['("%grammar",)'], self.next())
 
     def parseTokenPairs(self):
-        if self.next() in ("name",):
+        items = []
+        while self.next() in ("name",):
             var0_name = self.consume("name")
             var1_string = self.consume("string")
-            var2_TokenPairs = self.parseTokenPairs()
-            return var0_name, var1_string, var2_TokenPairs
-        return  # epsilon case
+            items.append((var0_name, var1_string))
+        rest = None
+        for var0_name, var1_string in reversed(items):
+            rest = var0_name, var1_string, rest
+        return rest
 
     def parseDecls(self):
-        if self.next() in ("name",):
-            var0_Decl = self.parseDecl()
-            var1_Decls = self.parseDecls()
-            return Declarations(('decl', var0_Decl),('rest', var1_Decls),)
-        return  # epsilon case
+        items = []
+        while self.next() in ("name",):
+            items.append(self.parseDecl())
+        rest = None
+        for var0_Decl in reversed(items):
+            rest = Declarations(('decl', var0_Decl),('rest', rest),)
+        return rest
 
     def parseDecl(self):
         if self.next() in ("name",):
@@ -218,12 +275,14 @@ class Parser(object):
         self.parsefail(['("string", "lopt", "lrepeat", "lset", "name",)', '("epsilon",)'], self.next())
 
     def parseAlts(self):
-        if self.next() in ("bar",):
+        items = []
+        while self.next() in ("bar",):
             var0_bar = self.consume("bar")
-            var1_Alt = self.parseAlt()
-            var2_Alts = self.parseAlts()
-            return Alternatives(('_', var0_bar),('alt', var1_Alt),('alts', var2_Alts),)
-        return  # epsilon case
+            items.append((var0_bar, self.parseAlt()))
+        rest = None
+        for var0_bar, var1_Alt in reversed(items):
+            rest = Alternatives(('_', var0_bar),('alt', var1_Alt),('alts', rest),)
+        return rest
 
     def parseExp(self):
         if self.next() in ("lrepeat",):
@@ -247,11 +306,13 @@ class Parser(object):
         self.parsefail(['("lrepeat",)', '("lset",)', '("lopt",)', '("string", "name",)'], self.next())
 
     def parseExps(self):
-        if self.next() in ("string", "lopt", "lrepeat", "lset", "name",):
-            var0_Exp = self.parseExp()
-            var1_Exps = self.parseExps()
-            return Expr(('exp', var0_Exp),('exps', var1_Exps),)
-        return  # epsilon case
+        items = []
+        while self.next() in ("string", "lopt", "lrepeat", "lset", "name",):
+            items.append(self.parseExp())
+        rest = None
+        for var0_Exp in reversed(items):
+            rest = Expr(('exp', var0_Exp),('exps', rest),)
+        return rest
 
     def parseBinding(self):
         if self.next() in ("pound",):
@@ -271,25 +332,81 @@ class Parser(object):
         self.parsefail(['("name",)', '("string",)'], self.next())
 
     def parseNames(self):
-        if self.next() in ("name",):
-            var0_name = self.consume("name")
-            var1_Names = self.parseNames()
-            return Names(('termname', var0_name),('names', var1_Names),)
-        return  # epsilon case
+        items = []
+        while self.next() in ("name",):
+            items.append(self.consume("name"))
+        rest = None
+        for var0_name in reversed(items):
+            rest = Names(('termname', var0_name),('names', rest),)
+        return rest
 
     def _parseRoot(self):
         return self.parseSpec()
 
 
-def main():
-    with open(sys.argv[1]) as f:
-        s = f.read()
+def emit(s, table=False, loops=False, dfa=False, contextual=False, optimize=False, inline=False,
+         instrument=False, profile=None):
+    # Return the Emitter that has emitted a parser module for the grammar spec s
     p = Parser()
     ast = p.parse(s)
-    e = Emitter(ast)
+    e = Emitter(ast, table, loops, dfa, contextual, optimize, inline, instrument, profile)
     e.emit()
-    text = e.objs + PCLASS + e.parser + MAIN
-    print(text)
+    return e
+
+def source(e):
+    # The source of the parser module the Emitter e has emitted
+    return e.objs + PCLASS + e.parser + (PROFILEMAIN if e.instrument else MAIN)
+
+def generate(s, table=False, loops=False, dfa=False, contextual=False, optimize=False, inline=False,
+             instrument=False, profile=None):
+    # Return the source of a parser module for the grammar spec s
+    return source(emit(s, table, loops, dfa, contextual, optimize, inline, instrument, profile))
+
+def main():
+    cli = argparse.ArgumentParser(description="Generate an LL(1) parser from an EBNF grammar.")
+    cli.add_argument("grammar", help="EBNF grammar file")
+    cli.add_argument("--table", action="store_true",
+                     help="emit a table-driven parser with an explicit stack instead of recursive descent")
+    cli.add_argument("--loops", action="store_true",
+                     help="parse tail-recursive list rules (Decls := Decl Decls | $) with loops returning flat lists")
+    cli.add_argument("--dfa", action="store_true",
+                     help="lex with a DFA compiled from the token regexes instead of one master regex")
+    cli.add_argument("--contextual", action="store_true",
+                     help="scan each token once the parser needs it, trying only the tokens it expects there")
+    cli.add_argument("-O", dest="optimize", action="store_true",
+                     help="emit parse functions without logging checks, reading each lookahead once")
+    cli.add_argument("--inline", action="store_true",
+                     help="splice small and single-use rules into the productions using them instead of calling them")
+    cli.add_argument("--chains", action="store_true",
+                     help="report on stderr how many parse functions are called to reach each token")
+    cli.add_argument("--profile", action="store_true",
+                     help="emit a parser that counts the productions taken, and writes them to a profile file")
+    cli.add_argument("--profile-data", metavar="FILE",
+                     help="order each rule's productions by the counts a --profile parser wrote to FILE, most taken first")
+    args = cli.parse_args()
+    if args.table and args.loops:
+        cli.error("--loops only applies to recursive-descent parsers")
+    if args.table and args.contextual:
+        cli.error("--contextual only applies to recursive-descent parsers")
+    if args.table and args.optimize:
+        cli.error("-O only applies to recursive-descent parsers")
+    if args.table and (args.inline or args.chains):
+        cli.error("--inline and --chains only apply to recursive-descent parsers")
+    if args.table and (args.profile or args.profile_data):
+        cli.error("--profile and --profile-data only apply to recursive-descent parsers")
+    if args.dfa and args.contextual:
+        cli.error("--dfa and --contextual are different lexers; choose one")
+    with open(args.grammar) as f:
+        s = f.read()
+    profile = None
+    if args.profile_data:
+        with open(args.profile_data) as f:
+            profile = json.load(f)
+    e = emit(s, args.table, args.loops, args.dfa, args.contextual, args.optimize, args.inline, args.profile, profile)
+    if args.chains:
+        for name, calls in e.chains():
+            print("{:<16} {}".format(name, calls), file=sys.stderr)
+    print(source(e))
 
 if __name__ == "__main__":
     main()
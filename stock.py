@@ -1,4 +1,261 @@
 PCLASS = '''
+def shiftrefs(regex, shift):
+    # Renumber the backreferences in a token regex once its groups have
+    # been moved up by shift places inside the master pattern.
+    out = ''
+    i = 0
+    while i < len(regex):
+        j = i + 1
+        if regex[i] == '\\\\' and j < len(regex):
+            j += 1
+            if regex[i+1] in '123456789':
+                while j < len(regex) and regex[j].isdigit():
+                    j += 1
+                out += '\\\\' + str(int(regex[i+1:j]) + shift)
+                i = j
+                continue
+        out += regex[i:j]
+        i = j
+    return out
+
+def lexpattern(skip, lexmap, keywords={}, order=None):
+    # Join the token regexes into one alternation of named groups, tried in
+    # declaration order, the tokens to skip first. Returns the pattern and a
+    # map of group -> token kind, where a kind is the token's index in
+    # lexmap, or WHITESPACE for those skipped. Tokens in keywords (see
+    # KEYWORDS) are left out. order, if given, lists the indexes in skip +
+    # lexmap of the tokens to try instead, in the order to try them.
+    alts = []
+    kinds = {}
+    groups = 0
+    left = set(kind + len(skip) for words in keywords.values() for kind in words.values())
+    tokens = skip + lexmap
+    for i in range(len(tokens)) if order is None else order:
+        name, regex = tokens[i]
+        if i in left:
+            continue
+        group = name if name.isidentifier() else "_tok{}".format(i)
+        if group in kinds:
+            group = "_tok{}".format(i)
+        kinds[group] = max(i - len(skip), WHITESPACE)
+        alts.append("(?P<{}>{})".format(group, shiftrefs(regex, groups + 1)))
+        groups += 1 + re.compile(regex).groups
+    return '|'.join(alts), kinds
+
+WHITESPACE = -1
+UNSCANNED = -2  # the lookahead's kind until --contextual scans it
+CUT = -3  # a token the end of what has been read of a file may cut short
+SKIP = [('whitespace', '\\s+'),] + IGNORE
+LEXPATTERN, LEXKINDS = lexpattern(SKIP, LEXMAP, KEYWORDS)
+BYTEKEYWORDS = dict((kind, dict((text.encode(), k) for text, k in words.items())) for kind, words in KEYWORDS.items())
+LEXER = re.compile(LEXPATTERN)
+BYTELEXER = None  # LEXER for bytes input, compiled on first use
+TOKKINDS = dict((name, kind) for kind, name in enumerate(TOKNAMES))
+CHUNKSIZE = 1 << 16  # characters or bytes read at a time from a file
+LEXGUARD = 1024  # input past where lexing stopped kept as remaining
+FILELEXER = None  # see filelexer()
+ENTER, TOKEN, EXIT = 'enter', 'token', 'exit'
+
+def tokname(kind):
+    if kind is None:
+        return 'EOF'
+    return TOKNAMES[kind]
+
+def bytelexer():
+    global BYTELEXER
+    if BYTELEXER is None:
+        BYTELEXER = re.compile(LEXPATTERN.encode())
+    return BYTELEXER
+
+def cutpattern(order):
+    # lexpattern(SKIP, LEXMAP, order=order) for a file read a chunk at a
+    # time: ahead of each token, its tail in LEXTAILS up to the end of the
+    # buffer, a group of kind CUT. So a match of kind CUT means a token no
+    # later than the one matched there might match, or match otherwise,
+    # once more is read.
+    tokens = SKIP + LEXMAP
+    cuts = []
+    kinds = []
+    for i in order:
+        cuts += [('_cut{}'.format(i), '(?:{})\\Z'.format(LEXTAILS[i])), tokens[i]]
+        kinds += [CUT, max(i - len(SKIP), WHITESPACE)]
+    pattern, groups = lexpattern([], cuts)
+    return pattern, dict((group, kinds[i]) for group, i in groups.items())
+
+def filelexer():
+    # (match, group -> kind) of LEXER for a file read a chunk at a time, by
+    # cutpattern(). Built the first time a file is lexed.
+    global FILELEXER
+    if FILELEXER is None:
+        left = set(kind + len(SKIP) for words in KEYWORDS.values() for kind in words.values())
+        pattern, kinds = cutpattern([i for i in range(len(SKIP) + len(LEXMAP)) if i not in left])
+        FILELEXER = re.compile(pattern).match, kinds
+    return FILELEXER
+
+NOTOKEN = len(SKIP) + len(LEXMAP)  # an order above every token's
+
+def dfatables(trans, accept, reach, columns, fallback, recheck, text):
+    # Flatten a DFA for dfamatch(), so that a state is the offset of its
+    # row and a step is one index, step[state + column]: the columns are
+    # the DFA's classes for str input, and each byte value for bytes,
+    # which are looked up in the input as it is. An order of None is
+    # taken as one above NOTOKEN, which no match can ever get to. The
+    # regexes are compiled for bytes unless text.
+    width = len(columns)
+    step = [row[c] * width if row[c] >= 0 else -1 for row in trans for c in columns]
+    final = [NOTOKEN + 1 if order is None else order for order in accept for c in columns]
+    reached = [NOTOKEN + 1 if order is None else order for order in reach for c in columns]
+    first = NOTOKEN if accept[0] is None else accept[0]  # a token matching the empty string
+    pattern, groups = lexpattern([], [(name, regex) for order, name, regex in fallback])
+    lexer = re.compile(pattern if text else pattern.encode()).match if fallback else None
+    orders = dict((group, fallback[i][0]) for group, i in groups.items())
+    tokens = SKIP + LEXMAP
+    checks = dict((order, re.compile(tokens[order][1] if text else tokens[order][1].encode()).match)
+                  for order in recheck)
+    return first, step, final, reached, lexer, orders, checks
+
+class CharClasses(dict):
+    # A str.translate() table of the DFA class of each character,
+    # bisected out of DFASTARTS the first time one is met
+    def __missing__(self, c):
+        cls = self[c] = DFACLASSES[bisect_right(DFASTARTS, c) - 1]
+        return cls
+
+DFASTR = dfatables(DFATRANS, DFAACCEPT, DFAREACH, range(DFANCLASSES), DFAFALLBACK, DFARECHECK,
+                   True) if DFATRANS is not None else None
+DFABYTES = dfatables(DFABYTETRANS, DFABYTEACCEPT, DFABYTEREACH, DFABYTECLASSES, DFABYTEFALLBACK,
+                     DFABYTERECHECK, False) if DFATRANS is not None else None
+DFACHARCLASSES = CharClasses()
+
+def dfaclasses(s):
+    # The DFA class of each character of s, as bytes
+    if s.isascii():
+        return s.encode('ascii').translate(DFAASCII)
+    return s.translate(DFACHARCLASSES).encode('latin-1')
+
+def dfamatch(s, i, n, classes, tables, starts):
+    # The token the master regex would match at s[i:n], found with the DFA:
+    # of the tokens matching there, the one declared first, with as much
+    # as re's match of it takes. classes is the column of each character
+    # of s (see dfatables), and starts the columns a token matched with re
+    # can start with, or None if any. Returns (order, end, stop), where
+    # order is NOTOKEN and end is i if nothing matches, and stop is where
+    # the scan stopped: n if it ran out of input, so a longer s might match
+    # otherwise.
+    order, step, final, reach, fallback, orders, checks = tables
+    state = 0
+    end = stop = i
+    while stop < n:
+        state = step[state + classes[stop]]
+        # stop where no token declared before order can match any more
+        if state < 0 or reach[state] > order:
+            break
+        stop += 1
+        if final[state] <= order:
+            order = final[state]
+            end = stop
+    if fallback and i < n and (starts is None or classes[i] in starts):
+        m = fallback(s, i, n)
+        if m and orders[m.lastgroup] < order:
+            order = orders[m.lastgroup]
+            end = m.end()
+            if end == n:
+                stop = n
+    if order in checks:
+        end = checks[order](s, i, n).end()
+        if end == n:
+            stop = n
+    return order, end, stop
+
+class TupleBuilder(object):
+    # Builds each node as a plain tuple (kind, field values...), and keeps
+    # tokens as their text
+    def make(self, kind, fields):
+        return (kind,) + tuple(fields.values())
+    def token(self, kind, text, span):
+        return text
+    def list(self, items):
+        return items
+
+class DictBuilder(object):
+    # Builds each node as a plain dict of its fields, with its kind under
+    # '_type', and keeps tokens as their text
+    def make(self, kind, fields):
+        fields['_type'] = kind
+        return fields
+    def token(self, kind, text, span):
+        return text
+    def list(self, items):
+        return items
+
+class TokenArrays(object):
+    # All the tokens of source, as parallel arrays: kinds, an array('H') of
+    # token kinds, and starts and ends, array('I')s of their offsets in
+    # source. Parser.parse takes one in place of source.
+    def __init__(self, source, kinds, starts, ends):
+        self.source = source
+        self.kinds = kinds
+        self.starts = starts
+        self.ends = ends
+    def __len__(self):
+        return len(self.kinds)
+    def numpy(self):
+        # The three arrays as NumPy arrays sharing their memory
+        import numpy
+        return (numpy.frombuffer(self.kinds, numpy.ushort),
+                numpy.frombuffer(self.starts, numpy.uintc),
+                numpy.frombuffer(self.ends, numpy.uintc))
+
+def tokenize_arrays(source):
+    # Scan all of source, a str or a bytes or mmap buffer, into a TokenArrays
+    lexer = LEXER if isinstance(source, str) else bytelexer()
+    keywords = KEYWORDS if isinstance(source, str) else BYTEKEYWORDS
+    groups = LEXKINDS
+    kinds = array('H')
+    starts = array('I')
+    ends = array('I')
+    addkind, addstart, addend = kinds.append, starts.append, ends.append
+    i = 0
+    if DFATRANS is not None:
+        if isinstance(source, str):
+            classes, tables, fallback = dfaclasses(source), DFASTR, DFAFALLBACKCLASSES
+        else:
+            classes, tables, fallback = source, DFABYTES, DFABYTEFALLBACKCLASSES
+        n = len(source)
+        while i < n:
+            order, j, stop = dfamatch(source, i, n, classes, tables, fallback)
+            if j == i:
+                break
+            kind = DFAKINDS[order]
+            if kind in keywords:
+                kind = keywords[kind].get(source[i:j] if classes is not source else bytes(source[i:j]), kind)
+            if kind != WHITESPACE:
+                addkind(kind)
+                addstart(i)
+                addend(j)
+            i = j
+    else:
+        for m in lexer.finditer(source):
+            j = m.end()
+            if m.start() != i or i == j:
+                break
+            kind = groups[m.lastgroup]
+            if kind in keywords:
+                kind = keywords[kind].get(m.group(), kind)
+            if kind != WHITESPACE:
+                addkind(kind)
+                addstart(i)
+                addend(j)
+            i = j
+    if i < len(source):
+        p = Parser()
+        p.setsource(source)
+        p.start = i
+        p.remaining = source[i:i+50]
+        p.scanfail()
+    return TokenArrays(source, kinds, starts, ends)
+
+
 class Parser(object):
 
     class ScanError(Exception):
@@ -6,83 +263,564 @@ class Parser(object):
     class ParseError(Exception):
         pass
     def parsefail(self, expected, found, val=None):
-        raise Parser.ParseError("Parse Error, line {}: Expected token {}, but found token {}:{}".format(self.line, expected, found, val))
+        if isinstance(expected, int):
+            expected = tokname(expected)
+        else:
+            expected = tuple(tokname(x) for x in sorted(expected))
+        found = tokname(found)
+        if isinstance(val, tuple):
+            val = self.text(val)  # the span of a token of bytes input
+        raise Parser.ParseError("Parse Error, {}: Expected token {}, but found token {}:{}".format(self.location(), expected, found, val))
     def scanfail(self):
-        raise Parser.ScanError("Lexer Error, line {}: No matching token found. Remaining input: {} ....".format(self.line, self.remaining[:50]))
+        raise Parser.ScanError("Lexer Error, {}: No matching token found. Remaining input: {} ....".format(self.location(), self.remaining[:50]))
 
 
-    def __init__(self, log=False):
-        lex = [('whitespace', '\s+'),] + [ x for x in LEXMAP ]
-        rules = [ (regex, self.makeHandler(tokenName)) for tokenName, regex in lex ]
-        self.scanner = re.Scanner(rules)
-        self.line = 1
+    def __init__(self, log=False, builder=None):
         self.log = log
+        self.start = 0
+        self.setsource('')
+        self.builder = None
+        if builder is not None:
+            self.usebuilder(builder)
+
+    def usebuilder(self, builder):
+        # Build the AST with builder rather than the node classes. builder
+        # has make(kind, fields) for nodes, with fields a new dict of the
+        # named values; token(kind, text, span) for tokens, with span the
+        # (start, end) offsets of text; and list(items) for repetitions.
+        # They shadow this instance's node classes, consume and makelist.
+        for kind, fields in NODES.items():
+            setattr(self, kind, self.nodemaker(builder.make, kind, fields))
+        self.builder = builder
+        self.consume = self.consumetoken
+        self.makelist = builder.list
+
+    def nodemaker(self, make, kind, fields):
+        def node(*values, **named):
+            values = dict(zip(fields, values))
+            values.update(named)
+            return make(kind, values)
+        return node
 
     def parse(self, s):
-        self.toks, self.remaining = self.scanner.scan(s)
-        self.trim()
+        self.toks = self.tokenize(s)
+        self.remaining = ''
+        self.advance()
         res = self._parseRoot()
-        if self.toks:
-            raise Parser.ParseError("Couldn't parse all of input. Next token: ", self.toks[0])
+        if self.next() is not None:
+            raise Parser.ParseError("Couldn't parse all of input. Next token: ", (tokname(self.tok), self.match))
         return res
 
-    def makeHandler(self, token):
-        return lambda scanner, string : (token, string)
+    def parse_tokens(self, tokens):
+        # parse() tokens lexed elsewhere: an iterable of (kind, text) or
+        # (kind, text, (start, end)) items, each kind a name in LEXMAP. They
+        # are pulled one at a time, as the parser needs them. A builder is
+        # given each item's span as it is, or None, and errors say which
+        # item they are at.
+        self.toks = self.tokenizeitems(tokens)
+        self.remaining = ''
+        self.advance()
+        res = self._parseRoot()
+        if self.next() is not None:
+            raise Parser.ParseError("Couldn't parse all of input. Next token: ", (tokname(self.tok), self.match))
+        return res
+
+    def parse_iter(self, s):
+        # parse(), but yield each item of the root rule's list as soon as it
+        # is parsed, without keeping the list or the AST around it
+        self.toks = self.tokenize(s)
+        self.remaining = ''
+        self.advance()
+        yield from self._iterRoot()
+        if self.next() is not None:
+            raise Parser.ParseError("Couldn't parse all of input. Next token: ", (tokname(self.tok), self.match))
+
+    def setsource(self, source, base=0):
+        # Track positions in source, which starts at offset base of the input
+        self.source = source
+        self.base = base
+        self.newlines = None  # offsets of the newlines in source
+        if base == 0:
+            self.linebase = 0  # newlines before base
+            self.linestart = -1  # offset of the last of them
 
-    def trim(self):
-        if self.toks:
-            token, match = self.toks[0]
-            if token == "whitespace":
-                self.line += match.count('\\n')
-                self.toks.pop(0)
-                self.trim()
+    def position(self, offset):
+        # (line, column) of an offset in the input, both counting from 1.
+        # Positions are only kept as offsets while parsing; this bisects an
+        # index of the newlines in the source, built the first time it's
+        # needed.
+        if self.newlines is None:
+            newline = '\\n' if isinstance(self.source, str) else b'\\n'
+            self.newlines = [m.start() + self.base for m in re.finditer(newline, self.source)]
+        i = bisect_left(self.newlines, offset)
+        linestart = self.newlines[i-1] if i else self.linestart
+        return self.linebase + i + 1, offset - linestart
+
+    def location(self):
+        # Where the lookahead is, for error messages: in parse_tokens, which
+        # has no source, the index of its item
+        if self.source is None:
+            return "token {}".format(self.start)
+        return "line {}, column {}".format(*self.position(self.start))
+
+    @property
+    def line(self):
+        # Line of the lookahead token, or of where scanning stopped
+        return self.position(self.start)[0]
+
+    def tokenize(self, s):
+        # Lazily yield (kind, match, start) triples, one lookahead at a
+        # time, so the input is never scanned into a list up front.
+        # Whitespace is skipped here, and the last triple is (None, None,
+        # where scanning stopped). s is a str, a bytes or mmap buffer (see tokenizebytes), or a file
+        # to read as it is scanned (see tokenizefile).
+        if isinstance(s, str):
+            if DFATRANS is not None:
+                return self.tokenizedfa(s)
+            return self.tokenizestr(s)
+        elif isinstance(s, (bytes, bytearray, mmap.mmap)):
+            if DFATRANS is not None:
+                return self.tokenizedfa(s)
+            return self.tokenizebytes(s)
+        elif isinstance(s, TokenArrays):
+            return self.tokenizearrays(s)
+        return self.tokenizefile(s)
+
+    def tokenizestr(self, s):
+        self.setsource(s)
+        match = LEXER.match
+        kinds = LEXKINDS
+        keywords = KEYWORDS
+        i = 0
+        while True:
+            m = match(s, i)
+            if not m:
+                break
+            j = m.end()
+            if i == j:
+                break
+            token = kinds[m.lastgroup]
+            if token != WHITESPACE:
+                text = m.group()
+                if token in keywords:
+                    token = keywords[token].get(text, token)
+                yield token, text, i
+            i = j
+        self.remaining = s[i:]
+        yield None, None, i
+
+    def tokenizedfa(self, s):
+        # tokenize() with the --dfa tables (see dfamatch), for str input or
+        # a bytes-like buffer or mmap; a token of bytes is its span, as with
+        # tokenizebytes.
+        self.setsource(s)
+        if isinstance(s, str):
+            classes, tables, starts, keywords = dfaclasses(s), DFASTR, DFAFALLBACKCLASSES, KEYWORDS
+        else:
+            classes, tables, starts, keywords = s, DFABYTES, DFABYTEFALLBACKCLASSES, BYTEKEYWORDS
+        text = classes is not s
+        kinds = DFAKINDS
+        n = len(s)
+        i = 0
+        while i < n:
+            order, j, stop = dfamatch(s, i, n, classes, tables, starts)
+            if j == i:
+                break
+            token = kinds[order]
+            if token != WHITESPACE:
+                if text:
+                    value = s[i:j]
+                    if token in keywords:
+                        token = keywords[token].get(value, token)
+                else:
+                    value = (i, j)
+                    if token in keywords:
+                        token = keywords[token].get(bytes(s[i:j]), token)
+                yield token, value, i
+            i = j
+        self.remaining = s[i:] if text else s[i:i+LEXGUARD]
+        yield None, None, i
+
+    def tokenizebytes(self, buf):
+        # tokenize() over a bytes-like buffer or mmap, with LEXER's pattern
+        # compiled for bytes (so \\w and \\s only match ASCII). Tokens are
+        # left in buf as their (start, end) offsets instead of being sliced
+        # out, and stay that way in the AST; text() decodes one.
+        self.setsource(buf)
+        match = bytelexer().match
+        kinds = LEXKINDS
+        keywords = BYTEKEYWORDS
+        i = 0
+        while True:
+            m = match(buf, i)
+            if not m:
+                break
+            j = m.end()
+            if i == j:
+                break
+            token = kinds[m.lastgroup]
+            if token != WHITESPACE:
+                if token in keywords:
+                    token = keywords[token].get(bytes(buf[i:j]), token)
+                yield token, m.span(), i
+            i = j
+        self.remaining = buf[i:i+LEXGUARD]
+        yield None, None, i
+
+    def tokenizearrays(self, toks):
+        # tokenize() over the arrays of a TokenArrays
+        source = toks.source
+        self.setsource(source)
+        if isinstance(source, str):
+            for kind, start, end in zip(toks.kinds, toks.starts, toks.ends):
+                yield kind, source[start:end], start
+        else:
+            for kind, start, end in zip(toks.kinds, toks.starts, toks.ends):
+                yield kind, (start, end), start
+        self.remaining = ''
+        yield None, None, len(source)
+
+    def tokenizeitems(self, items):
+        # tokenize() over the items given to parse_tokens. Kind names are
+        # looked up in TOKKINDS, built once from LEXMAP. There is no source;
+        # a token's offset is its index in items, and self.span the
+        # lookahead's span, or None.
+        self.setsource(None)
+        kinds = TOKKINDS
+        i = 0
+        for item in items:
+            kind = kinds.get(item[0])
+            if kind is None:
+                raise Parser.ScanError("Unknown token kind {!r} for token {} ({!r}); expected one of {}".format(
+                    item[0], i, item[1], ', '.join(TOKNAMES)))
+            self.span = item[2] if len(item) > 2 else None
+            yield kind, item[1], i
+            i += 1
+        self.span = None
+        self.remaining = ''
+        yield None, None, i
+
+    def text(self, span):
+        # The text of a token given as (start, end) by tokenizebytes
+        return str(self.source[span[0]:span[1]], 'utf-8')
+
+    def tokenizefile(self, f):
+        # tokenize() for a file object, text or binary (read as UTF-8), read
+        # CHUNKSIZE at a time. Until the input runs out, a token is only
+        # taken where no token that would win over it can be cut short by
+        # the end of what has been read (see filelexer); otherwise the
+        # unscanned tail is carried over to the next chunk, so a token
+        # crossing into it is still matched as it would be in one string.
+        # Memory use depends on the chunk size and the longest token, not on
+        # the size of the input, and a lexer error is raised as soon as
+        # nothing can match, however much is left.
+        keywords = KEYWORDS
+        dfa = DFATRANS is not None
+        filematch, filekinds = filelexer()
+        fallback = DFAFALLBACK if dfa else None
+        fallbackclasses = DFAFALLBACKCLASSES if dfa else None
+        chunks = self.readchunks(f)
+        buf = ''
+        classes = b''
+        base = 0  # offset of buf in the input
+        i = 0
+        self.setsource(buf)
+        while True:
+            chunk = next(chunks, None)
+            if chunk is None:
+                # all of the input is read, so nothing can be cut short
+                match, kinds, end = LEXER.match, LEXKINDS, None
+            else:
+                buf, base = self.refill(buf, base, i, chunk)
+                i = 0
+                if dfa:
+                    classes = dfaclasses(buf)
+                match, kinds, end = filematch, filekinds, len(buf)
+            while True:
+                if dfa:
+                    order, j, stop = dfamatch(buf, i, len(buf), classes, DFASTR, fallbackclasses)
+                    if stop == end:
+                        break
+                    if fallback and end is not None and (fallbackclasses is None or classes[i] in fallbackclasses):
+                        # a token matched with re might be cut short
+                        m = filematch(buf, i)
+                        if m and filekinds[m.lastgroup] == CUT:
+                            break
+                    token = DFAKINDS[order] if j > i else None
+                else:
+                    m = match(buf, i)
+                    token = kinds[m.lastgroup] if m else None
+                    if token == CUT:
+                        break
+                    j = m.end() if m else i
+                if j == i:
+                    if end is not None:
+                        # nothing matches, and more input can't change that
+                        self.start = base + i
+                        self.remaining = buf[i:i+LEXGUARD]
+                        self.scanfail()
+                    break
+                if token != WHITESPACE:
+                    text = buf[i:j]
+                    if token in keywords:
+                        token = keywords[token].get(text, token)
+                    yield token, text, base + i
+                i = j
+            if end is None:
+                self.remaining = buf[i:]
+                yield None, None, base + i
+                return
+
+    def refill(self, buf, base, i, chunk):
+        # Drop the scanned buf[:i], counting its lines for position(), and
+        # add the next chunk: the new buffer and its offset in the input
+        self.linebase += buf.count('\\n', 0, i)
+        newline = buf.rfind('\\n', 0, i)
+        if newline != -1:
+            self.linestart = base + newline
+        buf = buf[i:] + chunk
+        base += i
+        self.setsource(buf, base)
+        return buf, base
+
+    def readchunks(self, f):
+        read = f.read
+        decode = None
+        while True:
+            chunk = read(CHUNKSIZE)
+            if not chunk:
+                break
+            if not isinstance(chunk, str):
+                if decode is None:
+                    decode = codecs.getincrementaldecoder('utf-8')().decode
+                chunk = decode(chunk)
+            yield chunk
+        if decode is not None:
+            yield decode(b'', True)
+
+    def advance(self):
+        self.tok, self.match, self.start = next(self.toks, (None, None, None))
 
     def next(self):
-        if self.toks:
-            token,match = self.toks[0]
-            return token
-        elif self.remaining:
+        if self.tok is None and self.remaining:
             self.scanfail()
+        return self.tok
 
     def consume(self, tok):
-        if not self.toks and self.remaining:
-            self.scanfail()
-        if len(self.toks) == 0:
-            self.parsefail(tok, 'EOF')
-        token,match = self.toks.pop(0)
+        token, match = self.tok, self.match
+        if token is None:
+            if self.remaining:
+                self.scanfail()
+            self.parsefail(tok, None)
         if self.log:
-            print("consuming {}:{}".format(tok, match))
+            print("consuming {}:{}".format(tokname(tok), match))
         if tok != token:
             self.parsefail(tok, token, match)
-        self.trim()
+        self.advance()
         return match
 
+    def consumetoken(self, tok):
+        # consume() when a builder is in use
+        if self.tok == UNSCANNED:
+            self.scan(tok)
+        if self.source is None:
+            # an item given to parse_tokens, with its span as given
+            span = self.span
+            return self.builder.token(TOKNAMES[tok], Parser.consume(self, tok), span)
+        start = self.start
+        match = Parser.consume(self, tok)
+        if isinstance(match, tuple):
+            return self.builder.token(TOKNAMES[tok], self.text(match), match)
+        return self.builder.token(TOKNAMES[tok], match, (start, start + len(match)))
+
+    def makelist(self, items):
+        return items
+
     def pop(self):
         return self.consume(self.next())
 
 '''
 
+TABLEDRIVER = '''
+    def parsetable(self, start):
+        # Table-driven LL(1) parse of the nonterminal numbered start.
+        # Productions being parsed are kept on an explicit stack, so deep
+        # or long inputs don't use up the Python stack.
+        stack = []
+        symbols, build, loop = self.predict(start)
+        values = []
+        i = 0
+        while True:
+            if i < len(symbols):
+                sym = symbols[i]
+                i += 1
+                if sym >= 0:
+                    values.append(self.consume(sym))
+                else:
+                    stack.append((symbols, build, loop, values, i))
+                    symbols, build, loop = self.predict(~sym)
+                    values = []
+                    i = 0
+                continue
+            if loop is not None and self.next() in loop:
+                i = 0
+                continue
+            value = build(self, values)
+            if not stack:
+                return value
+            symbols, build, loop, values, i = stack.pop()
+            values.append(value)
+
+    def predict(self, nt):
+        table, default, expected = PARSETABLE[nt]
+        if self.log:
+            print(NONTERMINALS[nt])
+        prod = table.get(self.next(), default)
+        if prod is None:
+            self.parsefail(expected, self.next())
+        return PRODUCTIONS[prod]
+
+'''
+
+TABLERECOGNIZER = '''
+    def parsetable(self, start):
+        # Parser.parsetable, keeping no values
+        stack = []
+        symbols, build, loop = self.predict(start)
+        i = 0
+        while True:
+            if i < len(symbols):
+                sym = symbols[i]
+                i += 1
+                if sym >= 0:
+                    self.consume(sym)
+                else:
+                    stack.append((symbols, loop, i))
+                    symbols, build, loop = self.predict(~sym)
+                    i = 0
+                continue
+            if loop is not None and self.next() in loop:
+                i = 0
+                continue
+            if not stack:
+                return
+            symbols, loop, i = stack.pop()
+
+'''
+
+VALIDATE = '''
+def validate(s):
+    # Check s against the grammar without building an AST. Returns None if
+    # it parses, or else the ParseError or ScanError saying where it fails.
+    try:
+        Recognizer().parse(s)
+    except (Parser.ParseError, Parser.ScanError) as e:
+        return e
+
+'''
+
+PARSEITER = '''
+def parse_iter(source, builder=None):
+    # Parse source one item of the root list at a time (see Parser.parse_iter)
+    return Parser(builder=builder).parse_iter(source)
+
+def parse_tokens(tokens, builder=None):
+    # Parse tokens from another lexer (see Parser.parse_tokens)
+    return Parser(builder=builder).parse_tokens(tokens)
+
+'''
+
+EVENTPARSER = '''
+    def parse(self, s):
+        # Generator of the parse events for s
+        self.toks = self.tokenize(s)
+        self.remaining = ''
+        self.advance()
+        yield from self._parseRoot()
+        if self.next() is not None:
+            raise Parser.ParseError("Couldn't parse all of input. Next token: ", (tokname(self.tok), self.match))
+
+    def tokenevent(self, tok):
+        if self.tok == UNSCANNED:
+            self.scan(tok)
+        line = self.line
+        return TOKEN, TOKNAMES[tok], self.consume(tok), line
+
+'''
+
+TABLEEVENTS = '''
+    def parsetable(self, start):
+        # Parser.parsetable, yielding events instead of keeping values
+        stack = []
+        nt = start
+        while True:
+            if nt is not None:
+                symbols, loop, rule, binding = self.predictevent(nt)
+                if rule is not None:
+                    yield ENTER, rule, binding
+                nt = None
+                i = 0
+            if i < len(symbols):
+                sym = symbols[i]
+                i += 1
+                if sym >= 0:
+                    yield self.tokenevent(sym)
+                else:
+                    stack.append((symbols, loop, rule, i))
+                    nt = ~sym
+                continue
+            if loop is not None and self.next() in loop:
+                i = 0
+                continue
+            if rule is not None:
+                yield EXIT, rule
+            if not stack:
+                return
+            symbols, loop, rule, i = stack.pop()
+
+    def predictevent(self, nt):
+        # Parser.predict, also giving the rule and binding the production
+        # reports; rule is None for anonymous and empty productions
+        table, default, expected = PARSETABLE[nt]
+        if self.log:
+            print(NONTERMINALS[nt])
+        prod = table.get(self.next(), default)
+        if prod is None:
+            self.parsefail(expected, self.next())
+        symbols, build, loop = PRODUCTIONS[prod]
+        rule, binding = EVENTS[prod]
+        return symbols, loop, rule, binding
+
+'''
+
+ITERPARSE = '''
+def iterparse(s):
+    # Parse s as a stream of events, without building an AST: (ENTER, rule,
+    # binding) when a named rule starts, with binding the name given to the
+    # production taken or None; (TOKEN, kind, text, line) for each token;
+    # and (EXIT, rule) when the rule is done. Only the rules being parsed
+    # are held in memory.
+    return EventParser().parse(s)
+
+'''
+
 GOBJ='''
-import re, sys
+import re, sys, codecs, mmap
+from array import array
+from bisect import bisect_left, bisect_right
 
 class GrammarObj(object):
+    # Base of the generated node classes, each of which lists its fields
+    # in __slots__
+    __slots__ = ()
     def __str__(self):
-        return self.name
+        return type(self).__name__
     def __repr__(self):
-        s = self.name + '['
-        for k,v in self.attrs:
-            s += \"{}:{}, \".format(k,repr(v))
+        s = type(self).__name__ + '['
+        for k in self.__slots__:
+            s += \"{}:{}, \".format(k,repr(getattr(self, k)))
         s += ']'
         return s
-    def __init__(self, *args):
-        i = 0
-        for k,v in args:
-            if k == \"_\":
-                setattr(self, \"_anon{{}}\".format(i), v)
-                i += 1
-            else:
-                setattr(self, k, v)
-        self.attrs = args
 
 '''
 
@@ -95,11 +833,239 @@ def main():
         if sys.argv[2] == "-v":
             log = True
     with open(sys.argv[1]) as f:
-        s = f.read()
-    p = Parser(log)
-    ast = p.parse(s)
+        p = Parser(log)
+        ast = p.parse(f)
     print(repr(ast))
 
 if __name__ == "__main__":
     main()
 '''
+CONTEXTLEXER = '''
+CONTEXTLEXERS = {True: {}, False: {}, None: {}}  # str input? -> expected -> contextlexer()
+
+def contextlexer(expected, text=True):
+    # (match, group -> kind, keywords, carriers) for lexing just the skipped
+    # tokens and those in expected: a token kind or a set of them, or None
+    # for all of them. carriers are the tokens only tried for the keywords
+    # they match. text is None for a file read a chunk at a time, lexed as
+    # by cutpattern(). Compiled the first time each set is expected.
+    lexers = CONTEXTLEXERS[text]
+    if expected in lexers:
+        return lexers[expected]
+    if expected is None:
+        if text is None:
+            match, kinds = filelexer()
+        else:
+            match, kinds = (LEXER if text else bytelexer()).match, LEXKINDS
+        lexer = match, kinds, BYTEKEYWORDS if text is False else KEYWORDS, frozenset()
+        lexers[expected] = lexer
+        return lexer
+    key = expected
+    if isinstance(expected, int):
+        expected = (expected,)
+    # a keyword is lexed as the token that matches it, as in KEYWORDS; one
+    # that isn't expected stays that token, so it can be used as a name
+    carriers = dict((kind, carrier) for carrier, words in KEYWORDS.items() for kind in words.values())
+    tokens = sorted(set(carriers.get(kind, kind) for kind in expected if kind is not None))
+    keywords = dict((carrier, dict((word, kind) for word, kind in words.items() if kind in expected))
+                    for carrier, words in KEYWORDS.items() if carrier in tokens)
+    # and of literal tokens, longer ones are tried first, so that both '<'
+    # and '<=' can be expected whichever is declared first
+    slots = [i for i, kind in enumerate(tokens) if kind in LITERALS]
+    literals = sorted((tokens[i] for i in slots), key=lambda kind: -len(LITERALS[kind]))
+    for i, kind in zip(slots, literals):
+        tokens[i] = kind
+    order = list(range(len(SKIP))) + [len(SKIP) + kind for kind in tokens]
+    if text is None:
+        pattern, kinds = cutpattern(order)
+    else:
+        pattern, kinds = lexpattern(SKIP, LEXMAP, order=order)
+    if text is False:
+        pattern = pattern.encode()
+        keywords = dict((carrier, dict((word.encode(), kind) for word, kind in words.items()))
+                        for carrier, words in keywords.items())
+    lexer = re.compile(pattern).match, kinds, keywords, frozenset(tokens).difference(expected)
+    lexers[key] = lexer
+    return lexer
+
+'''
+
+CONTEXTUAL = '''
+    # --contextual: the lookahead is only scanned once the parser looks at
+    # it, trying just the tokens it can take there (see contextlexer)
+
+    def tokenize(self, s):
+        self.expected = None  # until the parser scans for something
+        if isinstance(s, TokenArrays):
+            return self.tokenizearrays(s)
+        elif isinstance(s, (str, bytes, bytearray, mmap.mmap)):
+            return self.tokenizecontext(s)
+        return self.tokenizecontextfile(s)
+
+    def lexcontext(self, s, i, text):
+        # The token at s[i] and its match, with contextlexer(self.expected).
+        # If nothing expected is there, the token is lexed as usual, for
+        # the parser to report; (None, None) if nothing matches. With text
+        # None, s is read from a file, and the token may be CUT.
+        lexers = CONTEXTLEXERS[text]
+        expected = self.expected
+        if expected in lexers:
+            match, kinds, keywords, carriers = lexers[expected]
+        else:
+            match, kinds, keywords, carriers = contextlexer(expected, text)
+        m = match(s, i)
+        token = kinds[m.lastgroup] if m and m.end() > i else None
+        if token in keywords:
+            token = keywords[token].get(m.group(), token)
+            if token in carriers:
+                token = None
+        if token is None:
+            match, kinds, keywords, carriers = contextlexer(None, text)
+            m = match(s, i)
+            if not m or m.end() == i:
+                return None, None
+            token = kinds[m.lastgroup]
+            if token in keywords:
+                token = keywords[token].get(m.group(), token)
+        return token, m
+
+    def tokenizecontext(self, s):
+        # tokenize(), matching each token with lexcontext()
+        self.setsource(s)
+        text = isinstance(s, str)
+        lex = self.lexcontext
+        i = 0
+        while True:
+            token, m = lex(s, i, text)
+            if m is None:
+                break
+            if token != WHITESPACE:
+                yield token, m.group() if text else m.span(), i
+            i = m.end()
+        self.remaining = s[i:i+LEXGUARD]
+        yield None, None, i
+
+    def tokenizecontextfile(self, f):
+        # tokenizecontext() for a file object, text or binary (read as
+        # UTF-8), read a chunk at a time as by tokenizefile: until the input
+        # runs out, a token is only matched where no expected or skipped
+        # token that would win over it can be cut short by the end of what
+        # has been read (see cutpattern); otherwise the next chunk is read
+        # and it is matched again.
+        chunks = self.readchunks(f)
+        lex = self.lexcontext
+        buf = ''
+        base = 0  # offset of buf in the input
+        i = 0
+        more = True  # until the input runs out
+        self.setsource(buf)
+        while True:
+            token, m = lex(buf, i, None if more else True)
+            if more and (token == CUT or i == len(buf)):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    more = False
+                else:
+                    buf, base = self.refill(buf, base, i, chunk)
+                    i = 0
+                continue
+            if m is None:
+                break
+            if token != WHITESPACE:
+                yield token, m.group(), base + i
+            i = m.end()
+        self.remaining = buf[i:i+LEXGUARD]
+        yield None, None, base + i
+
+    def advance(self):
+        self.tok = UNSCANNED
+
+    def scan(self, expected):
+        self.expected = expected
+        self.tok, self.match, self.start = next(self.toks, (None, None, None))
+
+    def peek(self, expected):
+        # The lookahead, scanned for the kinds in expected if it hasn't been
+        if self.tok == UNSCANNED:
+            self.scan(expected)
+        if self.tok is None and self.remaining:
+            self.scanfail()
+        return self.tok
+
+    def next(self):
+        return self.peek(None)
+
+    def consume(self, tok):
+        if self.tok == UNSCANNED:
+            self.scan(tok)
+        token, match = self.tok, self.match
+        if token is None:
+            if self.remaining:
+                self.scanfail()
+            self.parsefail(tok, None)
+        if self.log:
+            print("consuming {}:{}".format(tokname(tok), match))
+        if tok != token:
+            self.parsefail(tok, token, match)
+        self.tok = UNSCANNED
+        return match
+
+'''
+OPTIMIZED = '''
+    # -O: the parse functions don't check self.log; Parser(log=True) makes
+    # a TracedParser instead, which does the logging
+
+    def __new__(cls, log=False, builder=None):
+        if log and cls is Parser:
+            cls = TracedParser
+        return object.__new__(cls)
+
+    def consume(self, tok):
+        # consume() with advance() inlined, and no logging
+        token, match = self.tok, self.match
+        if tok != token:
+            if token is None and self.remaining:
+                self.scanfail()
+            self.parsefail(tok, token, match)
+        self.tok, self.match, self.start = next(self.toks, (None, None, None))
+        return match
+
+'''
+PROFILING = '''
+def writeprofile(path):
+    # Add how often each production has been taken, since the module was
+    # loaded or the profile last written, to the profile at path, for
+    # pygll.py --profile-data
+    import json
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        profile = {}
+    for rule, counts in PROFILE.items():
+        if len(profile.get(rule, counts)) != len(counts):
+            raise ValueError("Profile {} has {} productions for {}, not {}".format(path, len(profile[rule]), rule, len(counts)))
+        profile[rule] = [x + y for x, y in zip(profile.get(rule, [0] * len(counts)), counts)]
+        counts[:] = [0] * len(counts)
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=1, sort_keys=True)
+'''
+
+PROFILEMAIN = '''
+def main():
+    # Parse each file given, and add how often each production was taken
+    # to the profile given with -o, profile.json by default
+    args = sys.argv[1:]
+    path = "profile.json"
+    if args[:1] == ["-o"]:
+        path, args = args[1], args[2:]
+    if not args:
+        raise ValueError("Specify input files to parse")
+    for name in args:
+        with open(name) as f:
+            Parser().parse(f)
+    writeprofile(path)
+
+if __name__ == "__main__":
+    main()
+'''